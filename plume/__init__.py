@@ -1,4 +1,4 @@
 from .plume import (
-    Field, FloatField, ForeignKeyField, IntegerField, Model,
-    PrimaryKeyField, SQLiteDB, TextField,
+    BlobField, DateTimeField, EnumField, Field, FloatField, ForeignKeyField, GeneratedField,
+    IntegerField, JSONField, Model, PrimaryKeyField, SQLiteDB, TextField, fn,
 )
@@ -1,10 +1,21 @@
-from collections import namedtuple
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
 from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import copy
+import csv
+import io
+import json
+import re
 import sqlite3
+import sys
+import threading
+import time
+import zlib
 
 __all__ = [
-    'Field', 'FloatField', 'ForeignKeyField', 'IntegerField',
-    'Model', 'PrimaryKeyField', 'SQLiteDB', 'TextField',
+    'BlobField', 'DateTimeField', 'EnumField', 'Field', 'FloatField', 'ForeignKeyField',
+    'GeneratedField', 'IntegerField', 'JSONField', 'Model', 'PrimaryKeyField', 'SQLiteDB', 'TextField', 'fn',
 ]
 
 
@@ -24,6 +35,628 @@ class BracketCSV(CSV):
         return '(' + super().__str__() + ')'
 
 
+CacheStats = namedtuple('CacheStats', ('hits', 'misses', 'evictions', 'size'))
+
+
+class QueryCache:
+    """
+    A LRU cache of SelectQuery results.
+
+    Each entry is keyed on the SQL of a query plus its parameters, and remembers the tables
+    the query reads from: any write on one of these tables through SQLiteDB.build evicts it.
+    """
+    __slots__ = ('_entries', '_keys_by_table', 'evictions', 'hits', 'max_entries', 'misses')
+
+    def __init__(self, max_entries=256):
+        self._entries = OrderedDict()
+        self._keys_by_table = defaultdict(set)
+        self.evictions = 0
+        self.hits = 0
+        self.max_entries = max_entries
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        expires_at, tables, result = self._entries.pop(key)
+        for table in tables:
+            keys = self._keys_by_table[table]
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_table[table]
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_table.clear()
+
+    def get(self, key):
+        """Return the cached result for the key, or None if it is missing or expired."""
+        entry = self._entries.get(key)
+
+        if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def invalidate(self, table):
+        """Evict every entry which reads from the provided table."""
+        for key in list(self._keys_by_table.get(table.lower(), ())):
+            self._remove(key)
+
+    def resize(self, max_entries):
+        self.max_entries = max_entries
+        self._evict()
+
+    def set(self, key, tables, result, ttl=None):
+        if key in self._entries:
+            self._remove(key)
+
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        self._entries[key] = (expires_at, tables, result)
+        for table in tables:
+            self._keys_by_table[table].add(key)
+
+        self._evict()
+
+    def stats(self):
+        return CacheStats(self.hits, self.misses, self.evictions, len(self._entries))
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+
+class PKCache:
+    """
+    A LRU cache of the rows of a model, by primary key, shared by the whole process.
+
+    It is enabled with the 'pk_cache' option of the Meta class of a model, which sets the
+    maximum number of cached rows. Lookups by primary key, including the ones made when
+    accessing a ForeignKeyField, are served from the cache. Updates and deletions on the table
+    through SQLiteDB.build evict the affected rows.
+    """
+    __slots__ = ('_rows', 'evictions', 'hits', 'max_entries', 'misses', 'model')
+
+    def __init__(self, model, max_entries):
+        self._rows = OrderedDict()
+        self.evictions = 0
+        self.hits = 0
+        self.max_entries = max_entries
+        self.misses = 0
+        self.model = model
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        self._rows.clear()
+
+    def evict(self, pk):
+        self._rows.pop(pk, None)
+
+    def get(self, pk):
+        """Return the cached values of a row, or None."""
+        values = self._rows.get(pk)
+
+        if values is None:
+            self.misses += 1
+            return None
+
+        self._rows.move_to_end(pk)
+        self.hits += 1
+        return values
+
+    def memory_usage(self):
+        """Return an estimation, in bytes, of the memory used by the cached rows."""
+        return sys.getsizeof(self._rows) + sum(
+            sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+            for values in self._rows.values()
+        )
+
+    def set(self, values):
+        # Rows read inside a transaction may be rolled back, like the QueryCache results.
+        if self.model._db._connection.in_transaction:
+            return
+
+        self._rows[values.pk] = values
+        self._rows.move_to_end(values.pk)
+
+        while len(self._rows) > self.max_entries:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return CacheStats(self.hits, self.misses, self.evictions, len(self._rows))
+
+    def warm(self, pks=None):
+        """
+        Load rows of the model into the cache.
+
+        Args:
+            pks: an optional iterable of primary keys to load. By default, the first rows of
+                the table are loaded until the cache is full.
+
+        Returns:
+            The number of loaded rows.
+        """
+        model = self.model
+        query = SelectQuery(db=model._db).tables(model)
+
+        if pks is None:
+            query = query.order_by(model.pk).limit(self.max_entries)
+        else:
+            query = query.where(model.pk >> list(pks))
+
+        rows = query.dicts()
+        for row in rows:
+            self.set(model._row(row))
+
+        return len(rows)
+
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMERIC_LITERAL = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w.])')
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_WHITESPACES = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(raw_query):
+    """
+    Returns the shape of a SQL statement: literals are replaced by '?', and lists of
+    placeholders, such as the values of an IN clause, are collapsed into '(...)'.
+    """
+    raw_query = _STRING_LITERAL.sub('?', raw_query)
+    raw_query = _NUMERIC_LITERAL.sub('?', raw_query)
+    raw_query = _PLACEHOLDER_LIST.sub('(...)', raw_query)
+    return _WHITESPACES.sub(' ', raw_query).strip()
+
+
+FingerprintStats = namedtuple(
+    'FingerprintStats', ('fingerprint', 'count', 'total_time', 'p50', 'p99', 'rows')
+)
+
+
+class QueryStats:
+    """
+    Execution statistics of the statements run through a database, aggregated by fingerprint.
+
+    For each fingerprint, the number of executions, the total execution time, the number of rows
+    returned or affected, and the durations of the last 'max_samples' executions, from which
+    percentiles are computed, are recorded.
+    """
+    __slots__ = ('_fingerprints', 'enabled', 'max_samples')
+
+    def __init__(self, max_samples=1000):
+        self._fingerprints = {}
+        self.enabled = True
+        self.max_samples = max_samples
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    @staticmethod
+    def _percentile(samples, percent):
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def dump(self, format='text', n=None, by='total_time'):
+        """Returns the statistics of the top 'n' fingerprints as a text table or as JSON."""
+        top = self.top(n, by)
+
+        if format == 'json':
+            return json.dumps([stats._asdict() for stats in top])
+
+        lines = ['{:>8} {:>12} {:>10} {:>10} {:>10}  {}'.format(
+            'count', 'total (ms)', 'p50 (ms)', 'p99 (ms)', 'rows', 'fingerprint'
+        )]
+        lines.extend(
+            '{:>8} {:>12.3f} {:>10.3f} {:>10.3f} {:>10}  {}'.format(
+                stats.count, stats.total_time * 1000, stats.p50 * 1000, stats.p99 * 1000,
+                stats.rows, stats.fingerprint,
+            )
+            for stats in top
+        )
+        return '\n'.join(lines)
+
+    def record(self, raw_query, seconds, rows):
+        if not self.enabled:
+            return
+
+        key = fingerprint(raw_query)
+        entry = self._fingerprints.get(key)
+        if entry is None:
+            # count, total time, rows, duration samples
+            entry = self._fingerprints[key] = [0, 0.0, 0, deque(maxlen=self.max_samples)]
+
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += rows
+        entry[3].append(seconds)
+
+    def reset(self):
+        self._fingerprints.clear()
+
+    def top(self, n=10, by='total_time'):
+        """
+        Returns the FingerprintStats of the 'n' fingerprints with the highest value for 'by',
+        which is one of 'count', 'total_time', 'p50', 'p99' or 'rows'.
+        """
+        if by not in FingerprintStats._fields[1:]:
+            raise ValueError("Unknown statistic '{}'.".format(by))
+
+        summaries = []
+        for key, (count, total_time, rows, samples) in self._fingerprints.items():
+            samples = sorted(samples)
+            summaries.append(FingerprintStats(
+                key, count, total_time,
+                self._percentile(samples, 50), self._percentile(samples, 99), rows,
+            ))
+
+        summaries.sort(key=lambda stats: getattr(stats, by), reverse=True)
+        return summaries if n is None else summaries[:n]
+
+
+class NPlusOneError(AssertionError):
+    """Raised when a NPlusOneDetector finds the same query shape executed too many times."""
+
+
+NPlusOne = namedtuple('NPlusOne', ('fingerprint', 'count', 'call_sites'))
+
+
+class NPlusOneDetector:
+    """
+    Detect N+1 query patterns, such as lazy ForeignKeyField lookups in a loop.
+
+    While the detector is active, each SELECT statement executed through the database is
+    fingerprinted. A fingerprint executed with more than 'threshold' different parameters is
+    reported along with the call sites, outside of Plume, which executed it. Unless
+    'raise_on_exit' is False, a NPlusOneError is raised when leaving the context.
+
+    The detector is a context manager, which can also back a pytest fixture:
+
+        @pytest.fixture
+        def n_plus_one(db):
+            with db.detect_n_plus_one(threshold=5) as detector:
+                yield detector
+    """
+    __slots__ = ('db', 'raise_on_exit', 'threshold', '_queries')
+
+    def __init__(self, db, threshold=10, raise_on_exit=True):
+        self.db = db
+        self.raise_on_exit = raise_on_exit
+        self.threshold = threshold
+        self._queries = {}
+
+    def __enter__(self):
+        self.db._listeners.append(self._on_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.db._listeners.remove(self._on_execute)
+
+        if exc_type is None and self.raise_on_exit and self.violations():
+            raise NPlusOneError(self.report())
+
+    @staticmethod
+    def _call_site():
+        frame = sys._getframe(2)
+        while frame is not None and frame.f_code.co_filename == __file__:
+            frame = frame.f_back
+
+        if frame is None:
+            return '<unknown>'
+
+        return '{}:{} in {}'.format(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+    def _on_execute(self, raw_query, values):
+        if not raw_query.lstrip()[:6].upper() == SQLiteDB.SELECT:
+            return
+
+        key = fingerprint(raw_query)
+        entry = self._queries.get(key)
+        if entry is None:
+            # distinct queries with their parameters, call sites
+            entry = self._queries[key] = (set(), Counter())
+
+        params = tuple(tuple(value) for value in values) if values else ()
+        entry[0].add((raw_query, params))
+        entry[1][self._call_site()] += 1
+
+    def report(self):
+        return '\n'.join(
+            'N+1 query pattern: {} executions of {}\n{}'.format(
+                violation.count, violation.fingerprint,
+                '\n'.join('    {} ({} times)'.format(*site) for site in violation.call_sites),
+            )
+            for violation in self.violations()
+        )
+
+    def violations(self):
+        """Returns a NPlusOne tuple for each fingerprint executed too many times."""
+        return [
+            NPlusOne(key, len(queries), call_sites.most_common())
+            for key, (queries, call_sites) in self._queries.items()
+            if len(queries) > self.threshold
+        ]
+
+
+class Deferred:
+    """Placeholder value of a field which has not been loaded from the database yet."""
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<deferred>'
+
+
+DEFERRED = Deferred()
+
+
+class ExportReport(namedtuple('ExportReport', ('rows', 'seconds'))):
+    """Number of rows written by a SelectQuery export, and the time it took."""
+    __slots__ = ()
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class LoadReport(namedtuple('LoadReport', ('rows', 'rejected', 'seconds'))):
+    """Number of rows inserted and rejected by a bulk load, and the time it took."""
+    __slots__ = ()
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class Savepoint:
+    """
+    A nestable transaction.
+
+    Outside of a transaction, a savepoint behaves like BEGIN/COMMIT. Inside a transaction,
+    rolling back a savepoint only cancels the statements executed since it was opened.
+    """
+    __slots__ = ('connection', 'name')
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def __enter__(self):
+        self.connection.execute('SAVEPOINT ' + self.name)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.connection.execute('ROLLBACK TO ' + self.name)
+        self.connection.execute('RELEASE ' + self.name)
+
+
+class Session:
+    """
+    An identity map, which ensures that each row is loaded as a single live model instance.
+
+    While a session is opened on a database, model instances loaded through a SelectQuery are
+    stored by table and primary key: further loads of the same row return the same instance,
+    and lookups by primary key are answered without querying the database.
+    Any update or delete on a table through SQLiteDB.build evicts the instances of this table,
+    or only the instance of the row when it is filtered by primary key.
+    """
+    __slots__ = ('_db', '_instances', '_previous')
+
+    def __init__(self, db):
+        self._db = db
+        self._instances = defaultdict(dict)
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = self._db._session
+        self._db._session = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._db._session = self._previous
+        self._previous = None
+
+    def __len__(self):
+        return sum(len(instances) for instances in self._instances.values())
+
+    def add(self, instance):
+        """Store an instance, unless another instance of the same row is already stored."""
+        instances = self._instances[instance.__class__.__name__.lower()]
+        return instances.setdefault(instance._values.pk, instance)
+
+    def clear(self):
+        self._instances.clear()
+
+    def get(self, model, pk):
+        """Return the stored instance of a model for a primary key, or None."""
+        instances = self._instances.get(model.__name__.lower())
+        return None if instances is None else instances.get(pk)
+
+    def invalidate(self, table, pk=None):
+        """Evict the instance of the provided primary key, or every instance of the table."""
+        if pk is None:
+            self._instances.pop(table.lower(), None)
+        else:
+            self._instances.get(table.lower(), {}).pop(pk, None)
+
+
+class BlobIO(io.RawIOBase):
+    """
+    A file-like object over a value of a BlobField, backed by SQLite incremental BLOB I/O.
+
+    Reads and writes only touch the requested chunk of the value, and 'readinto' fills a
+    caller-provided buffer (a bytearray or a memoryview) without allocating the whole value.
+    The size of a blob can not be changed through incremental I/O.
+    An optional 'on_close' callable is called once a writable blob is closed.
+    """
+    __slots__ = ('_blob', '_on_close', '_readonly')
+
+    def __init__(self, blob, readonly=True, on_close=None):
+        super().__init__()
+        self._blob = blob
+        self._on_close = on_close
+        self._readonly = readonly
+
+    def __len__(self):
+        return len(self._blob)
+
+    def close(self):
+        if not self.closed:
+            self._blob.close()
+            if not self._readonly and self._on_close is not None:
+                self._on_close()
+        super().close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._blob.read(len(buffer))
+        memoryview(buffer).cast('B')[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._blob.seek(offset, whence)
+        return self._blob.tell()
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._blob.tell()
+
+    def writable(self):
+        return not self._readonly
+
+    def write(self, data):
+        self._blob.write(data)
+        return len(data)
+
+
+MaintenanceReport = namedtuple('MaintenanceReport', (
+    'skipped', 'writes', 'wal_frames', 'checkpoint', 'freed_pages', 'seconds', 'error',
+))
+
+
+class Maintenance:
+    """
+    Run maintenance tasks on a database, at regular intervals, from a background thread.
+
+    Each cycle runs ANALYZE, bounded by 'PRAGMA analysis_limit', to refresh the statistics of
+    the query planner, a PASSIVE
+    WAL checkpoint, upgraded to a TRUNCATE checkpoint when the WAL holds at least
+    'truncate_frames' frames, and an incremental vacuum when at least 'vacuum_pages' pages are
+    free. A cycle is skipped when more than 'max_writes' writes have been executed through the
+    database since the previous one.
+
+    The thread uses its own connection to the database, so an in-memory database can not be
+    maintained and raises a ValueError. After each cycle, 'on_run' is called with a
+    MaintenanceReport.
+    """
+    __slots__ = (
+        'db', 'interval', 'max_writes', 'on_run', 'truncate_frames', 'vacuum_pages',
+        '_stop', '_thread', '_writes',
+    )
+
+    def __init__(
+        self, db, interval=60, truncate_frames=1000, vacuum_pages=100, max_writes=None, on_run=None
+    ):
+        if db.db_name in (':memory:', ''):
+            raise ValueError('An in-memory database can not be maintained from another connection.')
+
+        self.db = db
+        self.interval = interval
+        self.max_writes = max_writes
+        self.on_run = on_run
+        self.truncate_frames = truncate_frames
+        self.vacuum_pages = vacuum_pages
+        self._stop = threading.Event()
+        self._thread = None
+        self._writes = db._writes
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        connection = self.db._connect()
+        try:
+            while not self._stop.wait(self.interval):
+                self.run_once(connection)
+        finally:
+            connection.close()
+
+    def run_once(self, connection=None):
+        """Run a maintenance cycle, on a new connection if none is provided."""
+        if connection is None:
+            with closing(self.db._connect()) as connection:
+                return self.run_once(connection)
+
+        start = time.perf_counter()
+        writes, self._writes = self.db._writes - self._writes, self.db._writes
+        wal_frames = freed_pages = 0
+        checkpoint = error = None
+        skipped = self.max_writes is not None and writes > self.max_writes
+
+        if not skipped:
+            try:
+                # 'PRAGMA optimize' only analyzes the tables queried on its own connection.
+                connection.execute('PRAGMA analysis_limit = 400')
+                connection.execute('ANALYZE')
+
+                checkpoint = 'PASSIVE'
+                wal_frames = connection.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()[1]
+                if wal_frames >= self.truncate_frames:
+                    checkpoint = 'TRUNCATE'
+                    connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+                free_pages = connection.execute('PRAGMA freelist_count').fetchone()[0]
+                if free_pages >= self.vacuum_pages:
+                    connection.execute('PRAGMA incremental_vacuum').fetchall()
+                    freed_pages = free_pages - connection.execute('PRAGMA freelist_count').fetchone()[0]
+            except sqlite3.Error as exception:
+                # The database is busy: the maintenance is postponed to the next cycle.
+                skipped = True
+                error = exception
+
+        report = MaintenanceReport(
+            skipped, writes, wal_frames, checkpoint, freed_pages, time.perf_counter() - start, error
+        )
+
+        if self.on_run is not None:
+            self.on_run(report)
+
+        return report
+
+    def start(self):
+        if self.running:
+            return self
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='plume-maintenance', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
 class Transaction:
     __slots__ = ('connection')
 
@@ -41,22 +674,33 @@ class Transaction:
 
 
 class SQLiteDB:
-    __slots__ = ('db_name', '_connection')
+    __slots__ = (
+        'cache', 'db_name', 'stats', '_connection', '_functions', '_listeners', '_maintenance',
+        '_models', '_session', '_writes',
+    )
 
     # Create table query
+    ANY = 'ANY'
     AUTOINCREMENT = 'AUTOINCREMENT'
+    BLOB = 'BLOB'
     CREATE = 'CREATE'
     DEFAULT = 'DEFAULT'
     EXISTS = 'EXISTS'
+    GENERATED = 'GENERATED ALWAYS AS'
     IF = 'IF'
+    INDEX = 'INDEX'
     INTEGER = 'INTEGER'
     NOT_NULL = 'NOT NULL'
     PK = 'PRIMARY KEY'
     REAL = 'REAL'
     REFERENCES = 'REFERENCES'
+    STORED = 'STORED'
+    STRICT = 'STRICT'
     TABLE = 'TABLE'
     TEXT = 'TEXT'
     UNIQUE = 'UNIQUE'
+    VIRTUAL = 'VIRTUAL'
+    WITHOUT_ROWID = 'WITHOUT ROWID'
 
     #Delete query
     DELETE = 'DELETE'
@@ -72,31 +716,53 @@ class SQLiteDB:
     # Select Query
     ALL = '*'
     ASC = 'ASC'
+    ON = 'ON'
     BETWEEN = 'BETWEEN'
     DESC = 'DESC'
     DISTINCT = 'DISTINCT'
+    AS = 'AS'
     FROM = 'FROM'
+    JOIN = {'inner': 'INNER JOIN', 'left': 'LEFT JOIN'}
     LIMIT = 'LIMIT'
     OFFSET = 'OFFSET'
     ORDER_BY = 'ORDER BY'
+    OVER = 'OVER'
+    PARTITION_BY = 'PARTITION BY'
     SELECT = 'SELECT'
+    UNION_ALL = 'UNION ALL'
     WHERE = 'WHERE'
+    WITH_RECURSIVE = 'WITH RECURSIVE'
 
     #Update query
     SET = 'SET'
     UPDATE = 'UPDATE'
 
+    # Full-text search
+    FTS_SUFFIX = '_fts'
+    MATCH = 'MATCH'
+
     # Query Operators
+    ADD = '+'
     AND = 'AND'
+    CONCAT = '||'
+    DIV = '/'
+    JSON_EACH = 'SELECT value FROM json_each'
+    JSON_EXTRACT = 'json_extract'
     EQ = '='
     GE = '>='
     GT = '>'
     IN = 'IN'
     LE = '<='
     LT = '<'
+    MUL = '*'
+    NULL = 'NULL'
     OR = 'OR'
     NE = '!='
     NOT = 'NOT'
+    SUB = '-'
+
+    # Above this number of values, an IN operator binds its values as a single JSON array.
+    IN_THRESHOLD = 64
 
     invert = {
         BETWEEN: ' '.join((NOT, BETWEEN)),
@@ -106,31 +772,91 @@ class SQLiteDB:
     }
 
     def __init__(self, db_name):
+        self.cache = QueryCache()
         self.db_name = db_name
-        self._connection = sqlite3.connect(self.db_name, isolation_level=None)
-        self._connection.execute('PRAGMA foreign_keys = ON')
+        self.stats = QueryStats()
+        self._functions = {}
+        self._connection = self._connect()
+        self._listeners = []
+        self._maintenance = None
+        self._models = {}
+        self._session = None
+        self._writes = 0
+
+    def _connect(self):
+        """Open a new connection to the database, with every registered function."""
+        connection = sqlite3.connect(self.db_name, isolation_level=None)
+        connection.execute('PRAGMA foreign_keys = ON')
+
+        for name, definition in self._functions.items():
+            self._create_function(connection, name, *definition)
+
+        return connection
+
+    @staticmethod
+    def _create_function(connection, name, implementation, num_params, deterministic, aggregate):
+        if aggregate:
+            connection.create_aggregate(name, num_params, implementation)
+        else:
+            connection.create_function(
+                name, num_params, implementation, deterministic=deterministic
+            )
+
+    def _register_function(self, name, implementation, num_params, deterministic, aggregate):
+        definition = (implementation, num_params, deterministic, aggregate)
+        self._functions[name] = definition
+        self._create_function(self._connection, name, *definition)
+
+    def aggregate(self, name=None, num_params=-1):
+        """
+        Decorator which registers a class as a SQL aggregate on every connection of the database.
+
+        The class must implement the 'step' and 'finalize' methods of the sqlite3 aggregate
+        protocol. Aggregates are called in queries with 'fn': fn.name(Model.field).
+        """
+        def decorator(aggregate_class):
+            self._register_function(
+                name or aggregate_class.__name__, aggregate_class, num_params, False, True
+            )
+            return aggregate_class
+
+        return decorator
 
     def atomic(self):
         return Transaction(connection=self._connection)
 
+    def savepoint(self, name='plume'):
+        return Savepoint(connection=self._connection, name=name)
+
     def build(self, query, values=None, read_only=False):
         raw_query = query.build()
 
+        if values is None and isinstance(query, FilterableQuery):
+            params = query.params()
+            values = [params] if params else None
+
         if read_only:
             return self.execute(raw_query, values)
 
         if self._connection.in_transaction:
-            return self.execute(raw_query, values)
+            cursor = self.execute(raw_query, values)
+        else:
+            with self.atomic():
+                cursor = self.execute(raw_query, values)
 
-        with self.atomic():
-            return self.execute(raw_query, values)
+        self._invalidate(query)
+        return cursor
 
     def build_create(self, query):
-        query = (
+        output = [
             self.CREATE, self.TABLE, self.IF, self.invert[self.EXISTS],
             query._table.lower(), str(query._fields),
-        )
-        return ' '.join(query)
+        ]
+
+        if query._options:
+            output.append(str(CSV(query._options)))
+
+        return ' '.join(output)
 
     def build_delete(self, query):
         output = [self.DELETE, self.FROM, query._table.lower()]
@@ -140,12 +866,68 @@ class SQLiteDB:
 
         return ' '.join(output)
 
+    def build_fts(self, model):
+        """
+        Returns the statements creating a FTS5 index of the searchable fields of a model.
+
+        The index is an external content table, named after the table of the model, which
+        is kept in sync by triggers and filled with the existing rows when created.
+        """
+        fieldnames = sorted(
+            fieldname for fieldname in model._fieldnames
+            if getattr(getattr(model, fieldname), 'searchable', False)
+        )
+        if not fieldnames:
+            return []
+
+        if 'pk' not in model._fieldnames:
+            raise TypeError('A WITHOUT ROWID model can not have searchable fields.')
+
+        table = model.__name__.lower()
+        fts = table + self.FTS_SUFFIX
+        columns = str(CSV(fieldnames))
+        new_values = str(CSV('new.' + fieldname for fieldname in fieldnames))
+        old_values = str(CSV('old.' + fieldname for fieldname in fieldnames))
+        insert = "INSERT INTO {fts}(rowid, {columns}) VALUES (new.pk, {new_values});"
+        delete = "INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.pk, {old_values});"
+        trigger = "CREATE TRIGGER IF NOT EXISTS {fts}_{event} AFTER {event} ON {table} BEGIN {body} END"
+
+        statements = [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({columns}, content='{table}', content_rowid='pk')",
+            trigger.replace('{event}', 'INSERT').replace('{body}', insert),
+            trigger.replace('{event}', 'DELETE').replace('{body}', delete),
+            trigger.replace('{event}', 'UPDATE').replace('{body}', delete + ' ' + insert),
+            "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+        ]
+        return [
+            statement.format(
+                fts=fts, table=table, columns=columns, new_values=new_values, old_values=old_values
+            )
+            for statement in statements
+        ]
+
     def build_drop(self, query):
         query = (
             self.DROP, self.TABLE, self.IF, self.EXISTS, query._table.lower()
         )
         return ' '.join(query)
 
+    def build_indexes(self, model):
+        """Returns the statements creating the indexes declared by the fields of a model."""
+        table = model.__name__.lower()
+        columns = sorted(
+            column
+            for fieldname in model._fieldnames
+            for column in getattr(model, fieldname).indexed_columns()
+        )
+        return [
+            ' '.join((
+                self.CREATE, self.INDEX, self.IF, self.invert[self.EXISTS],
+                '_'.join((table, column)), self.ON, ''.join((table, '(', column, ')')),
+            ))
+            for column in columns
+        ]
+
     def build_insert(self, query):
         output = (
             self.INSERT, query._table.lower(),
@@ -156,29 +938,68 @@ class SQLiteDB:
         return ' '.join(output)
 
     def build_select(self, query):
-        output = [self.SELECT]
+        output = []
+
+        if query._ctes:
+            output.extend((self.WITH_RECURSIVE, str(CSV(
+                ' '.join((
+                    ''.join((name, str(BracketCSV(columns)))), self.AS,
+                    ''.join(('(', base.build(), ' ', self.UNION_ALL, ' ', step.build(), ')')),
+                ))
+                for name, columns, base, step in query._ctes
+            ))))
+
+        output.append(self.SELECT)
 
         if query._distinct:
             output.append(self.DISTINCT)
 
-        fields = str(CSV(query._fields)) if query._fields else self.ALL
+        indexes = query._full_text_indexes()
+        if query._fields:
+            fields = str(CSV(query._fields))
+        elif indexes and not query._joins:
+            # Columns of the joined FTS5 indexes are not part of the rows.
+            table = query._tables[0]
+            fields = '.'.join(((table if isinstance(table, str) else table.__name__).lower(), self.ALL))
+        elif query._joins:
+            # Columns of joined tables share names, so each one is aliased as table__column.
+            fields = str(CSV(
+                ' '.join((str(getattr(model, fieldname)), self.AS, alias))
+                for model in query._models()
+                for fieldname, alias in query._aliases(model)
+            ))
+        else:
+            fields = self.ALL
         output.append(fields)
         if query._tables:
-            tables = (table if isinstance(table, str) else table.__name__ for table in query._tables)
-            output.extend((self.FROM, str(CSV(tables)).lower()))
+            tables = (
+                str(table) if isinstance(table, Alias)
+                else (table if isinstance(table, str) else table.__name__).lower()
+                for table in query._tables
+            )
+            output.extend((self.FROM, str(CSV(tables))))
+
+        for kind, model, on in query._joins:
+            output.extend((self.JOIN[kind], model.__name__.lower(), self.ON, str(on)))
+
+        for index in indexes:
+            output.extend((
+                self.JOIN['inner'], str(index), self.ON,
+                '{}.rowid = {}.pk'.format(index, index.model.__name__.lower()),
+            ))
 
         if query._filters is not None:
             output.extend((self.WHERE, str(query._filters)))
 
+        if query._order_by:
+            output.extend((self.ORDER_BY, str(CSV(query._order_by))))
+
         if query._limit is not None:
             output.extend((self.LIMIT, str(query._limit)))
 
         if query._offset is not None:
             output.extend((self.OFFSET, str(query._offset)))
 
-        if query._order_by:
-            output.extend((self.ORDER_BY, str(CSV(query._order_by))))
-
         return ' '.join(output)
 
     def build_update(self, query):
@@ -195,11 +1016,35 @@ class SQLiteDB:
     def delete(self):
         return DeleteQuery(db=self)
 
+    def function(self, name=None, num_params=-1, deterministic=True):
+        """
+        Decorator which registers a Python function as a SQL function on every connection of the
+        database.
+
+        Functions are called in queries with 'fn': fn.name(Model.field). A deterministic function
+        always returns the same result for the same arguments, which allows SQLite to use it in
+        indexes on expressions.
+        """
+        def decorator(implementation):
+            self._register_function(
+                name or implementation.__name__, implementation, num_params, deterministic, False
+            )
+            return implementation
+
+        return decorator
+
+    def detect_n_plus_one(self, threshold=10, raise_on_exit=True):
+        """Return a NPlusOneDetector, to be used as a context manager."""
+        return NPlusOneDetector(self, threshold, raise_on_exit)
+
     def drop(self, table=None):
         query = DropQuery(db=self)
         return query if table is None else query.table(table)
 
-    def execute(self, raw_query, values=None):
+    def _execute(self, raw_query, values=None):
+        for listener in self._listeners:
+            listener(raw_query, values)
+
         cursor = self._connection.cursor()
         if values is None:
             return cursor.execute(raw_query)
@@ -208,33 +1053,162 @@ class SQLiteDB:
         else:
             return cursor.executemany(raw_query, values)
 
+    def execute(self, raw_query, values=None):
+        """Execute a statement and record its duration and number of affected rows."""
+        start = time.perf_counter()
+        cursor = self._execute(raw_query, values)
+        self.stats.record(raw_query, time.perf_counter() - start, max(cursor.rowcount, 0))
+        return cursor
+
+    def fetch(self, raw_query, values=None):
+        """
+        Execute a query and fetch its whole result, recording its duration and number of rows.
+
+        Returns:
+            A tuple with the list of column names and the list of rows.
+        """
+        start = time.perf_counter()
+        cursor = self._execute(raw_query, values)
+        rows = cursor.fetchall()
+        self.stats.record(raw_query, time.perf_counter() - start, len(rows))
+        return [field[0] for field in cursor.description], rows
+
     def insert(self):
         return InsertQuery(db=self)
 
+    def _invalidate(self, query):
+        """Evict the cached results, rows and instances which may be altered by a write query."""
+        self._writes += 1
+        table = query._table.lower()
+        self.cache.invalidate(table)
+
+        # New rows don't alter the rows already loaded.
+        if isinstance(query, (CreateQuery, InsertQuery)):
+            return
+
+        model = self._models.get(table)
+        pk = None
+        if model is not None and isinstance(query, FilterableQuery):
+            pk = query._primary_key_filter(model)
+
+        if self._session is not None:
+            self._session.invalidate(table, pk)
+
+        if model is None or model.pk_cache is None:
+            return
+
+        if pk is None:
+            model.pk_cache.clear()
+        else:
+            model.pk_cache.evict(pk)
+
     def register(self, *args):
         try:
             for model_class in args:
                 model_class._db = self
+                self._models[model_class.__name__.lower()] = model_class
                 self.create().from_model(model_class).execute()
+                for statement in self.build_indexes(model_class):
+                    self.execute(statement)
+                self._create_fts(model_class)
+                # Rows cached for a previously registered database are stale.
+                if model_class.pk_cache is not None:
+                    model_class.pk_cache.clear()
         except TypeError:
             raise TypeError('{arg} is not a valid Model subclass.'.format(arg=model_class.__name__))
 
+    def _create_fts(self, model):
+        """Create the full-text search index of a model, if it has searchable fields."""
+        statements = self.build_fts(model)
+        fts = model.__name__.lower() + self.FTS_SUFFIX
+        # The triggers are dropped with the table of the model, while the index may remain.
+        names = [fts] + ['_'.join((fts, event)) for event in ('INSERT', 'DELETE', 'UPDATE')]
+        existing = self._connection.execute(
+            "SELECT count(*) FROM sqlite_master WHERE name IN (?, ?, ?, ?)", names
+        ).fetchone()[0]
+
+        if not statements or existing == len(names):
+            return
+
+        with self.atomic():
+            for statement in statements:
+                self._connection.execute(statement)
+
+    def _drop_fts(self, table):
+        """Drop the full-text search index of a table, which is not dropped with the table."""
+        self.build(DropQuery(db=self).table(table + self.FTS_SUFFIX))
+
     def select(self, *args):
         return SelectQuery(db=self).select(*args)
 
+    def session(self):
+        """Return a Session, to be used as a context manager."""
+        return Session(db=self)
+
+    def start_maintenance(self, interval=60, **options):
+        """
+        Start running maintenance tasks on the database from a background thread.
+
+        See Maintenance for the available options.
+        """
+        self.stop_maintenance()
+        self._maintenance = Maintenance(self, interval=interval, **options).start()
+        return self._maintenance
+
+    def stop_maintenance(self, timeout=None):
+        if self._maintenance is not None:
+            self._maintenance.stop(timeout)
+            self._maintenance = None
+
     def update(self, *args):
         return UpdateQuery(db=self).fields(*args)
 
+    def with_recursive(self, name, columns, base, step):
+        return SelectQuery(db=self).with_recursive(name, columns, base, step)
+
+    def variable_limit(self):
+        """Returns the maximum number of parameters a single statement can bind."""
+        try:
+            return self._connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        except AttributeError:
+            # Connection.getlimit is only available since Python 3.11.
+            return 999
+
 
 class BaseModel(type):
     def __new__(cls, clsname, bases, attrs):
+        # Model options are declared in an optional inner Meta class.
+        meta = attrs.pop('Meta', None)
+        pk_cache_size = getattr(meta, 'pk_cache', None)
+        primary_key = tuple(getattr(meta, 'primary_key', ()))
+        without_rowid = getattr(meta, 'without_rowid', False)
+        attrs['_strict'] = getattr(meta, 'strict', False)
+        attrs['_without_rowid'] = without_rowid
+
+        if without_rowid != bool(primary_key):
+            raise TypeError(
+                "<{}> A WITHOUT ROWID model needs a 'primary_key', "
+                "which is only allowed on WITHOUT ROWID models.".format(clsname)
+            )
+
+        if without_rowid and pk_cache_size:
+            raise TypeError('<{}> A WITHOUT ROWID model can not have a PKCache.'.format(clsname))
+
         fieldnames = set()
         # Collect all field names from the base classes.
         for base in bases:
             fieldnames.update(getattr(base, '_fieldnames', []))
 
-        fieldnames.add('pk')
-        attrs['pk'] = PrimaryKeyField()
+        if without_rowid:
+            # Rows are identified by the fields of their primary key instead of a rowid.
+            fieldnames.discard('pk')
+            attrs['pk'] = None
+        else:
+            fieldnames.add('pk')
+            attrs['pk'] = PrimaryKeyField(autoincrement=getattr(meta, 'autoincrement', True))
+            primary_key = ('pk',)
+
+        attrs['_primary_key'] = primary_key
 
         related_fields = []
         for attr_name, attr_value in attrs.items():
@@ -249,6 +1223,12 @@ class BaseModel(type):
         # Add the tuple of field names as attribute of the Model class.
         attrs['_fieldnames'] = tuple(fieldnames)
 
+        missing = set(primary_key) - fieldnames
+        if missing:
+            raise TypeError('<{}> Unknown primary key fields: {}.'.format(
+                clsname, ', '.join(sorted(missing))
+            ))
+
         # Add instance factory class
         attrs['_factory'] = namedtuple('InstanceFactory', fieldnames)
 
@@ -262,11 +1242,43 @@ class BaseModel(type):
         for fieldname in model._fieldnames:
             getattr(model, fieldname).model = model
 
+        for _, related_field in related_fields:
+            if related_field.related_model == 'self':
+                related_field.related_model = model
+            # Foreign keys reference the 'pk' field of their related model.
+            if related_field.related_model._without_rowid:
+                raise TypeError(
+                    '<{}> A foreign key can not reference the WITHOUT ROWID model {}.'.format(
+                        clsname, related_field.related_model.__name__
+                    )
+                )
+
+        model.pk_cache = PKCache(model, pk_cache_size) if pk_cache_size else None
+
+        # Generated fields are computed by SQLite, and never written by the model.
+        model._generated = tuple(
+            fieldname for fieldname in model._fieldnames
+            if isinstance(getattr(model, fieldname), GeneratedField)
+        )
+
         return model
 
 class Node:
     __slots__ = ()
 
+    def __add__(self, other):
+        return Operation(self, SQLiteDB.ADD, self.format(other))
+
+    def alias(self, name):
+        """Name the node in the output of a query: fn.count(Trainer.pk).alias('total')."""
+        return Alias(self, name)
+
+    def asc(self):
+        return Expression(self, SQLiteDB.ASC)
+
+    def desc(self):
+        return Expression(self, SQLiteDB.DESC)
+
     def __and__(self, other):
         return Expression(self, SQLiteDB.AND, self.format(other))
 
@@ -283,8 +1295,8 @@ class Node:
         return Expression(self, SQLiteDB.AND, self.format(other))
 
     def __invert__(self):
-        self.op = SQLiteDB.invert[self.op]
-        return self
+        # Expressions are shared between queries, so the negation is a new expression.
+        return Expression(self.lo, SQLiteDB.invert[self.op], self.ro)
 
     def __le__(self, other):
         return Expression(self, SQLiteDB.LE, self.format(other))
@@ -292,33 +1304,315 @@ class Node:
     def __lt__(self, other):
         return Expression(self, SQLiteDB.LT, self.format(other))
 
+    def __mul__(self, other):
+        return Operation(self, SQLiteDB.MUL, self.format(other))
+
     def __or__(self, other):
         return Expression(self, SQLiteDB.OR, self.format(other))
 
     def __ne__(self, other):
         return Expression(self, SQLiteDB.NE, self.format(other))
 
+    def __radd__(self, other):
+        return Operation(self.format(other), SQLiteDB.ADD, self)
+
+    def __rmul__(self, other):
+        return Operation(self.format(other), SQLiteDB.MUL, self)
+
+    def __rsub__(self, other):
+        return Operation(self.format(other), SQLiteDB.SUB, self)
+
+    def __rtruediv__(self, other):
+        return Operation(self.format(other), SQLiteDB.DIV, self)
+
     def __rshift__(self, expressions):
         if not isinstance(expressions, SelectQuery):
+            expressions = list(expressions)
+
+            # Large lists of literals are not written in the query, so the SQL stays short
+            # and SQLite reads them as a table it can join on an index.
+            if len(expressions) > SQLiteDB.IN_THRESHOLD and all(
+                isinstance(exp, (int, float, str)) for exp in expressions
+            ):
+                return Expression(self, SQLiteDB.IN, JSONArray(expressions))
+
             expressions = BracketCSV((self.format(exp) for exp in expressions))
         return Expression(self, SQLiteDB.IN, expressions)
 
+    def __sub__(self, other):
+        return Operation(self, SQLiteDB.SUB, self.format(other))
+
+    def __truediv__(self, other):
+        return Operation(self, SQLiteDB.DIV, self.format(other))
+
+    def _arguments(self, values):
+        """
+        Returns values formatted as arguments of a Function.
+
+        Formatted values are already SQL, so they are wrapped in an Expression, which is not
+        formatted again as a literal by the Function.
+        """
+        return [Expression(self.format(value)) for value in values]
+
+    def coalesce(self, *values):
+        return Function('coalesce', self, *self._arguments(values))
+
+    def concat(self, other):
+        return Operation(self, SQLiteDB.CONCAT, self.format(other))
+
     def format(self, expression):
         return expression
 
+    def max(self, *values):
+        """Returns the greatest of the node and the provided values, as the SQL max(x, y)."""
+        return Function('max', self, *self._arguments(values))
+
+    def min(self, *values):
+        """Returns the lowest of the node and the provided values, as the SQL min(x, y)."""
+        return Function('min', self, *self._arguments(values))
+
+
+def literal(value):
+    """Returns the SQL literal of a Python value."""
+    if value is None:
+        return SQLiteDB.NULL
+
+    if isinstance(value, str):
+        return ''.join(("'", value.replace("'", "''"), "'"))
+
+    if isinstance(value, bool):
+        return int(value)
+
+    return value
+
+
+def collect_params(value, params):
+    """Append the values of every Param in an expression tree, in their SQL output order."""
+    if isinstance(value, Param):
+        params.append(value.value)
+    elif isinstance(value, Expression):
+        # The operator can be a subquery, as in EXISTS (SELECT ...).
+        collect_params(value.lo, params)
+        collect_params(value.op, params)
+        collect_params(value.ro, params)
+    elif isinstance(value, Function):
+        for arg in value.args:
+            collect_params(arg, params)
+    elif isinstance(value, Alias):
+        collect_params(value.node, params)
+    elif isinstance(value, CSV):
+        for element in value:
+            collect_params(element, params)
+    elif isinstance(value, FilterableQuery):
+        params.extend(value.params())
+
+    return params
+
+
+class Param(Node):
+    """A value bound to a '?' placeholder instead of being written in the SQL query."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return SQLiteDB.PLACEHOLDER
+
+
+class JSONArray(Param):
+    """A list of values bound as a single JSON array parameter, read as a table by json_each."""
+    __slots__ = ()
+
+    def __init__(self, values):
+        super().__init__(json.dumps(values))
+
+    def __str__(self):
+        return ''.join(('(', SQLiteDB.JSON_EACH, '(', SQLiteDB.PLACEHOLDER, '))'))
+
 
 class Expression(Node):
-    __slots__ = ('lo', 'op', 'ro')
+    """
+    An expression, which is never modified once created: its SQL output is compiled once,
+    so queries sharing it don't compile it again.
+    """
+    __slots__ = ('_sql', 'lo', 'op', 'ro')
 
     def __init__(self, lo, op=None, ro=None):
+        self._sql = None
         self.lo = lo
         self.op = op
         self.ro = ro
 
     def __str__(self):
+        if self._sql is None:
+            self._sql = self._compile()
+
+        return self._sql
+
+    def _compile(self):
         return ' '.join(str(e) for e in (self.lo, self.op, self.ro) if e is not None)
 
 
+class Operation(Expression):
+    """An arithmetic or string operation, which is output between brackets to be nested."""
+    __slots__ = ()
+
+    def _compile(self):
+        return ''.join(('(', super()._compile(), ')'))
+
+    def format(self, expression):
+        return literal(expression)
+
+
+class Function(Node):
+    """A call to a SQL function."""
+    __slots__ = ('_sql', 'args', 'name')
+
+    def __init__(self, name, *args):
+        self._sql = None
+        self.args = args
+        self.name = name
+
+    def __str__(self):
+        # Like an Expression, a function is never modified, so its output is compiled once.
+        if self._sql is None:
+            self._sql = ''.join((self.name, str(BracketCSV(literal(arg) for arg in self.args))))
+
+        return self._sql
+
+    def format(self, expression):
+        return literal(expression)
+
+    def over(self, partition_by=(), order_by=()):
+        """
+        Turn the function into a window function, computed over a set of rows related
+        to each row: fn.row_number().over(partition_by=Event.user, order_by=Event.date.desc())
+
+        Args:
+            partition_by: fields, or a single field, grouping the rows of each window.
+            order_by: fields or sort strings, or a single one, ordering the rows of each window.
+        """
+        return Window(self, partition_by, order_by)
+
+
+class Window(Node):
+    """A window function: function() OVER (PARTITION BY ... ORDER BY ...)."""
+    __slots__ = ('_sql', 'function', 'order_by', 'partition_by')
+
+    def __init__(self, function, partition_by=(), order_by=()):
+        self._sql = None
+        self.function = function
+        self.order_by = tuple(order_by) if isinstance(order_by, (list, tuple)) else (order_by,)
+        self.partition_by = (
+            tuple(partition_by) if isinstance(partition_by, (list, tuple)) else (partition_by,)
+        )
+
+    def __str__(self):
+        if self._sql is None:
+            self._sql = self._compile()
+
+        return self._sql
+
+    def _compile(self):
+        clauses = []
+
+        if self.partition_by:
+            clauses.extend((SQLiteDB.PARTITION_BY, str(CSV(str(field) for field in self.partition_by))))
+
+        if self.order_by:
+            clauses.extend((SQLiteDB.ORDER_BY, str(CSV(str(field) for field in self.order_by))))
+
+        return ' '.join((str(self.function), SQLiteDB.OVER, ''.join(('(', ' '.join(clauses), ')'))))
+
+
+class Alias(Node):
+    """A node named in the output of a query, or a subquery named as a table."""
+    __slots__ = ('name', 'node')
+
+    def __init__(self, node, name):
+        self.name = name
+        self.node = node
+
+    def __str__(self):
+        return ' '.join((str(self.node), SQLiteDB.AS, self.name))
+
+
+class FunctionFactory:
+    """Build calls to SQL functions: fn.lower(Trainer.name) outputs lower(trainer.name)."""
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        return lambda *args: Function(name, *args)
+
+
+fn = FunctionFactory()
+
+
+class FullTextIndex(Node):
+    """
+    The FTS5 index of a model, or one of its columns: article_fts.body.
+
+    A select query using it is joined to the index, on the rowid of the index.
+    """
+    __slots__ = ('column', 'model')
+
+    def __init__(self, model, column=None):
+        self.column = column
+        self.model = model
+
+    def __str__(self):
+        fts = self.model.__name__.lower() + SQLiteDB.FTS_SUFFIX
+        return fts if self.column is None else '.'.join((fts, self.column))
+
+
+class JSONPath(Node):
+    """
+    A value inside the JSON document of a JSONField: Event.payload['user']['id'] outputs
+    json_extract(event.payload, '$.user.id').
+
+    A path declared in the indexes of the field outputs its indexed generated column instead.
+    """
+    __slots__ = ('field', 'keys')
+
+    def __init__(self, field, keys):
+        self.field = field
+        self.keys = keys
+
+    def __getitem__(self, key):
+        return JSONPath(self.field, self.keys + (key,))
+
+    def __str__(self):
+        if self.keys in self.field.indexes:
+            table = self.field.model.__name__.lower()
+            return '.'.join((table, self.field.column_name(self.keys)))
+
+        return str(Function(SQLiteDB.JSON_EXTRACT, self.field, self.path(self.keys)))
+
+    @staticmethod
+    def path(keys):
+        """Returns the SQLite JSON path of a sequence of keys: ('tags', 0) outputs '$.tags[0]'."""
+        output = ['$']
+        for key in keys:
+            if isinstance(key, int):
+                output.append('[{}]'.format(key))
+            elif key.isidentifier():
+                output.extend(('.', key))
+            else:
+                output.append('."{}"'.format(key.replace('"', '\\"')))
+
+        return ''.join(output)
+
+    def format(self, expression):
+        if isinstance(expression, (dict, list)):
+            return literal(JSONField.encoder.encode(expression))
+
+        return expression if isinstance(expression, Node) else literal(expression)
+
+
 class Field(Node):
     __slots__ = ('default', 'model', 'name', 'required', 'unique', 'value')
     internal_type = None
@@ -344,7 +1638,7 @@ class Field(Node):
         is returned.
         """
         if instance is not None:
-            return getattr(instance._values, self.name)
+            return self.to_python(instance._get_value(self.name))
         else:
             return self
 
@@ -353,13 +1647,13 @@ class Field(Node):
         Default setter of a Field subclass.
 
         The provided 'value' is stored in the hidden '_values' dictionnary of the instance,
-        if the type of the value correspond to the 'internal_type' of the Fied subclass.
-        Otherwise, throw a TypeError exception.
+        converted to its database value, if the type of the value correspond to the
+        'internal_type' of the Fied subclass. Otherwise, throw a TypeError exception.
 
         The setter is only accessed through a model instance,
         """
         if self.is_valid(value):
-            instance._values._replace(**{self.name: value})
+            instance._values = instance._values._replace(**{self.name: self.to_db(value)})
 
     def __str__(self):
         return '.'.join((self.model.__name__.lower(), self.name))
@@ -373,9 +1667,28 @@ class Field(Node):
         )
         return Expression(self, self.model._db.BETWEEN, and_clause)
 
+    def cast(self, value):
+        """Convert a raw value, read from a CSV or JSON file, to the internal type of the field."""
+        if value is None or value == '':
+            return None
+
+        return value if isinstance(value, self.internal_type) else self.internal_type(value)
+
     def desc(self):
         return ' '.join((str(self), self.model._db.DESC))
 
+    def generated_columns(self):
+        """Returns the definitions of the columns generated from the field."""
+        return []
+
+    def in_strict_table(self):
+        """Returns True if the field belongs to a model declared as STRICT."""
+        return self.model is not None and self.model._strict
+
+    def indexed_columns(self):
+        """Returns the names of the columns to index for the field."""
+        return []
+
     def is_valid(self, value):
         """Return True if the provided value match the internal field."""
         if value is not None and not isinstance(value, self.internal_type):
@@ -400,68 +1713,430 @@ class Field(Node):
 
         return field_definition
 
+    def to_db(self, value):
+        """Convert a Python value to the value stored in the database."""
+        return value
+
+    def to_python(self, value):
+        """Convert a value stored in the database to a Python value."""
+        return value
+
 
 class TextField(Field):
-    __slots__ = ()
+    """
+    A field storing text.
+
+    A searchable TextField is indexed in a FTS5 table when its model is registered, and
+    can be filtered with 'match' and ranked with 'bm25'.
+
+    A TextField with a 'compress' codec stores the values longer than 'threshold' bytes
+    compressed, as a BLOB starting with a marker byte, and decompresses them when they are
+    accessed. Compressed values can't be compared nor searched in SQL.
+    """
+    __slots__ = ('compress', 'searchable', 'threshold')
+    # Codecs by name: marker byte, compress function, decompress function.
+    codecs = {'zlib': (b'\x01', zlib.compress, zlib.decompress)}
     internal_type = str
     sqlite_datatype = SQLiteDB.TEXT
 
+    def __init__(self, *args, searchable=False, compress=None, threshold=512, **kwargs):
+        super().__init__(*args, **kwargs)
+        if compress is not None and compress not in self.codecs:
+            raise ValueError("Unknown compression codec '{}'.".format(compress))
+
+        if compress is not None and searchable:
+            raise TypeError('A compressed TextField is not searchable.')
+
+        self.compress = compress
+        self.searchable = searchable
+        self.threshold = threshold
+
+    def _fts_column(self):
+        if not self.searchable:
+            raise TypeError("Field '{}' is not searchable.".format(self.name))
+
+        return FullTextIndex(self.model, self.name)
+
+    def bm25(self):
+        """
+        Returns the relevance of each row matched by match() in the same select query,
+        to be used in order_by(): Article.select().where(Article.body.match('pikachu'))
+        .order_by(Article.body.bm25()).
+
+        Lower values mean more relevant rows. The relevance is computed by the FTS5 index
+        joined to the table, so it is not computed again for each row.
+        """
+        self._fts_column()
+        return Function('bm25', FullTextIndex(self.model))
+
+    def cast(self, value):
+        # An empty CSV cell is a valid empty string for a text field.
+        return value if value is None else str(value)
+
     def format(self, expression):
-        return ''.join(("'", expression, "'")) if isinstance(expression, str) else expression
+        if not isinstance(expression, str):
+            return expression
+
+        # Compressed values are BLOBs, which are bound instead of being written in the query.
+        value = self.to_db(expression)
+        return Param(value) if isinstance(value, bytes) else literal(value)
+
+    def match(self, query):
+        """
+        Filter the rows of a select query whose value matches a FTS5 full-text query.
+
+        The FTS5 index of the model is joined to its table, so the query only runs once.
+        """
+        return Expression(self._fts_column(), SQLiteDB.MATCH, Param(query))
 
     def sql(self):
         field_representation = super().sql(set_default=False)
 
+        if self.compress is not None and self.in_strict_table():
+            # Compressed values are BLOBs, which a STRICT table refuses in a TEXT column.
+            field_representation[1] = SQLiteDB.ANY
+
         if self.default is not None:
             field_representation.extend(
                 (SQLiteDB.DEFAULT, ''.join(("'", str(self.default), "'")))
             )
         return field_representation
 
+    def to_db(self, value):
+        if self.compress is None or value is None:
+            return value
+
+        data = value.encode()
+        if len(data) <= self.threshold:
+            return value
+
+        marker, compress, _ = self.codecs[self.compress]
+        compressed = marker + compress(data)
+        # Keep incompressible values as text, so they stay comparable.
+        return compressed if len(compressed) < len(data) else value
+
+    def to_python(self, value):
+        if not isinstance(value, bytes):
+            return value
+
+        for marker, _, decompress in self.codecs.values():
+            if value[:1] == marker:
+                return decompress(value[1:]).decode()
+
+        raise ValueError("Value of field '{}' has an unknown compression marker.".format(self.name))
+
+
+class IntegerField(Field):
+    __slots__ = ()
+    internal_type = int
+    sqlite_datatype = SQLiteDB.INTEGER
+
+
+class FloatField(Field):
+    __slots__ = ()
+    internal_type = float
+    sqlite_datatype = SQLiteDB.REAL
+
+
+class DateTimeField(Field):
+    """
+    A field storing a datetime as an integer number of microseconds since the Unix epoch.
+
+    Integers are compact and compared without parsing, so sorts and range filters like
+    between() can use an index. Naive datetimes are considered as UTC, and aware datetimes
+    are converted to UTC: values are read back as naive UTC datetimes.
+    """
+    __slots__ = ()
+    EPOCH = datetime(1970, 1, 1)
+    MICROSECOND = timedelta(microseconds=1)
+    internal_type = datetime
+    sqlite_datatype = SQLiteDB.INTEGER
+
+    def cast(self, value):
+        # CSV cells and JSON values hold ISO 8601 datetimes.
+        if isinstance(value, str):
+            return datetime.fromisoformat(value) if value else None
+
+        return value
+
+    def format(self, expression):
+        return self.to_db(expression) if isinstance(expression, datetime) else expression
+
+    def sql(self):
+        field_representation = super().sql(set_default=False)
+
+        if self.default is not None:
+            field_representation.extend((SQLiteDB.DEFAULT, str(self.to_db(self.default))))
+
+        return field_representation
+
+    def to_db(self, value):
+        if value is None:
+            return None
+
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+
+        return (value - self.EPOCH) // self.MICROSECOND
+
+    def to_python(self, value):
+        return value if value is None else self.EPOCH + timedelta(microseconds=value)
+
+
+class EnumField(Field):
+    """
+    A field storing a member of an Enum class as its integer value.
+
+    Every member of the Enum class must have an integer value.
+    """
+    __slots__ = ('enum',)
+    sqlite_datatype = SQLiteDB.INTEGER
+
+    def __init__(self, enum, **kwargs):
+        if not all(isinstance(member.value, int) for member in enum):
+            raise TypeError("Members of '{}' must have integer values.".format(enum.__name__))
+
+        self.enum = enum
+        super().__init__(**kwargs)
+
+    def cast(self, value):
+        # CSV cells and JSON values hold the name or the value of a member.
+        if value is None or value == '':
+            return None
+
+        if isinstance(value, self.enum):
+            return value
+
+        if isinstance(value, str) and value in self.enum.__members__:
+            return self.enum[value]
+
+        return self.enum(int(value))
+
+    def format(self, expression):
+        return self.to_db(expression) if isinstance(expression, self.enum) else expression
+
+    def is_valid(self, value):
+        if value is not None and not isinstance(value, self.enum):
+            raise TypeError(
+                "Type of field '{field_name}' must be a member of {enum}.".format(
+                    field_name=self.name, enum=self.enum.__name__
+                )
+            )
+
+        return True
+
+    def sql(self):
+        field_representation = super().sql(set_default=False)
+
+        if self.default is not None:
+            field_representation.extend((SQLiteDB.DEFAULT, str(self.to_db(self.default))))
+
+        return field_representation
+
+    def to_db(self, value):
+        return value if value is None else value.value
+
+    def to_python(self, value):
+        return value if value is None else self.enum(value)
+
+
+class BlobField(Field):
+    """
+    A field storing binary data.
+
+    Large values can be read and written by chunks with Model.open_blob, instead of being
+    loaded whole into memory.
+    """
+    __slots__ = ()
+    internal_type = bytes
+    sqlite_datatype = SQLiteDB.BLOB
+
+    def is_valid(self, value):
+        if isinstance(value, (bytearray, memoryview)):
+            return True
+
+        return super().is_valid(value)
+
+
+class JSONField(Field):
+    """
+    A field storing a JSON document, encoded as compact text.
+
+    Values inside the document can be filtered with a path: Event.payload['user']['id'] == 5.
+    Each path declared in 'indexes', as a tuple of keys or a dotted string, is extracted
+    into an indexed generated column, which is then used by the filters on this path.
+
+    The document is decoded on each access, so it is changed by assigning a new document:
+    editing the decoded value in place, as in event.payload['x'] = 1, is lost.
+    """
+    __slots__ = ('indexes',)
+    encoder = json.JSONEncoder(ensure_ascii=False, check_circular=False, separators=(',', ':'))
+    internal_type = object
+    sqlite_datatype = SQLiteDB.TEXT
+
+    def __init__(self, indexes=(), **kwargs):
+        super().__init__(**kwargs)
+        self.indexes = tuple(
+            tuple(path.split('.')) if isinstance(path, str) else tuple(path) for path in indexes
+        )
+
+        for keys in self.indexes:
+            # The keys of an indexed path name its generated column.
+            if not all(isinstance(key, int) or key.isidentifier() for key in keys):
+                raise TypeError(
+                    'The keys of an indexed path must be identifiers or integers: {}'.format(keys)
+                )
+
+    def __getitem__(self, key):
+        return JSONPath(self, (key,))
+
+    def cast(self, value):
+        # CSV cells hold JSON text, while JSON Lines values are already decoded.
+        return json.loads(value) if isinstance(value, str) and value else value
+
+    def column_name(self, keys):
+        """Returns the name of the generated column of an indexed path."""
+        return '__'.join((self.name,) + tuple(str(key) for key in keys))
+
+    def format(self, expression):
+        return expression if isinstance(expression, Node) else literal(self.to_db(expression))
+
+    def generated_columns(self):
+        columns = []
+        for keys in self.indexes:
+            column = [self.column_name(keys)]
+            # A STRICT table requires a type for each column.
+            if self.in_strict_table():
+                column.append(SQLiteDB.ANY)
+            column.extend((
+                SQLiteDB.GENERATED,
+                ''.join(('(', SQLiteDB.JSON_EXTRACT, '(', self.name, ', ', literal(JSONPath.path(keys)), '))')),
+                SQLiteDB.VIRTUAL,
+            ))
+            columns.append(' '.join(column))
+
+        return columns
+
+    def indexed_columns(self):
+        return [self.column_name(keys) for keys in self.indexes]
+
+    def is_valid(self, value):
+        try:
+            self.encoder.encode(value)
+        except (TypeError, ValueError):
+            raise TypeError(
+                "Value of field '{}' must be serializable to JSON.".format(self.name)
+            )
+
+        return True
+
+    def sql(self):
+        field_representation = super().sql(set_default=False)
+
+        if self.default is not None:
+            field_representation.extend((SQLiteDB.DEFAULT, str(self.format(self.default))))
+
+        return field_representation
+
+    def to_db(self, value):
+        return value if value is None else self.encoder.encode(value)
+
+    def to_python(self, value):
+        return value if value is None else json.loads(value)
+
+
+class GeneratedField(Field):
+    """
+    A field computed by SQLite from the other columns of its row.
+
+    The expression is written in SQL and can only refer to columns of the same table,
+    without table name: GeneratedField("lower(name)"). A stored generated field is
+    computed when its row is written, while a virtual one is computed when it is read.
+    Either can be indexed, so filters and sorts on it don't scan the table.
+    """
+    __slots__ = ('expression', 'index', 'stored')
+    internal_type = object
+
+    def __init__(self, expression, stored=True, index=False, **kwargs):
+        kwargs.update(required=False)
+        super().__init__(**kwargs)
+        self.expression = expression
+        self.index = index
+        self.stored = stored
+
+    def format(self, expression):
+        # The type of a generated value depends on its expression.
+        return expression if isinstance(expression, Node) else literal(expression)
+
+    def indexed_columns(self):
+        return [self.name] if self.index else []
 
-class IntegerField(Field):
-    __slots__ = ()
-    internal_type = int
-    sqlite_datatype = SQLiteDB.INTEGER
+    def sql(self):
+        field_definition = [self.name]
 
+        # A STRICT table requires a type for each column.
+        if self.in_strict_table():
+            field_definition.append(SQLiteDB.ANY)
 
-class FloatField(Field):
-    __slots__ = ()
-    internal_type = float
-    sqlite_datatype = SQLiteDB.REAL
+        if self.unique:
+            field_definition.append(SQLiteDB.UNIQUE)
+
+        field_definition.extend((
+            SQLiteDB.GENERATED, ''.join(('(', self.expression, ')')),
+            SQLiteDB.STORED if self.stored else SQLiteDB.VIRTUAL,
+        ))
+        return field_definition
 
 
 class PrimaryKeyField(IntegerField):
-    __slots__ = ()
+    """
+    The primary key of a model, an alias of the rowid of its table.
 
-    def __init__(self, **kwargs):
+    Without AUTOINCREMENT, SQLite doesn't maintain the sqlite_sequence table on each insert,
+    but may reuse the primary key of the last row after it is deleted.
+    """
+    __slots__ = ('autoincrement',)
+
+    def __init__(self, *, autoincrement=True, **kwargs):
        kwargs.update(required=False)
        super().__init__(**kwargs)
+       self.autoincrement = autoincrement
 
     def sql(self):
-        return super().sql() + [SQLiteDB.PK, SQLiteDB.AUTOINCREMENT]
+        field_definition = super().sql() + [SQLiteDB.PK]
+
+        if self.autoincrement:
+            field_definition.append(SQLiteDB.AUTOINCREMENT)
+
+        return field_definition
 
 
 class ForeignKeyField(IntegerField):
+    """
+    A field storing the primary key of a row of a related model.
+
+    A model can reference itself with the 'self' related model, and the roots of such a
+    hierarchy are stored with a non required field: ForeignKeyField('self', 'children',
+    required=False).
+    """
     __slots__ = ('related_model', 'related_field')
 
-    def __init__(self, related_model, related_field):
-        super().__init__()
+    def __init__(self, related_model, related_field, **kwargs):
+        super().__init__(**kwargs)
         self.related_model = related_model
         self.related_field = related_field
 
     def __get__(self, instance, owner):
         if instance is not None:
-            related_pk_value = getattr(instance._values, self.name)
-            related_pk_field = getattr(self.related_model, 'pk')
-            return self.related_model.where(related_pk_field == related_pk_value)[0]
+            pk = instance._get_value(self.name)
+            return None if pk is None else self.related_model._get_by_pk(pk)
         else:
             return self
 
     def __set__(self, instance, value):
         """Store the primary key of a valid related model instance."""
         if self.is_valid(value):
-            instance._values._replace(**{self.name: value.pk})
+            instance._values = instance._values._replace(**{self.name: value.pk})
 
     def is_valid(self, value):
         if not isinstance(value, self.related_model):
@@ -476,6 +2151,9 @@ class ForeignKeyField(IntegerField):
     def sql(self):
         return super().sql() + [SQLiteDB.REFERENCES, self.related_model.__name__.lower() + '(pk)']
 
+    def to_db(self, value):
+        return value.pk if isinstance(value, Model) else value
+
 
 class Model(metaclass=BaseModel):
 
@@ -486,8 +2164,11 @@ class Model(metaclass=BaseModel):
             if getattr(self.__class__, fieldname).required and fieldname not in kwargs:
                 raise AttributeError("<{}> '{}' field is required: you need to provide a value.".format(self.__class__.__name__, fieldname))
 
-        kwargs.setdefault('pk', None)
-        self._values = self._factory(**kwargs)
+        if 'pk' in self._fieldnames:
+            kwargs.setdefault('pk', None)
+        for fieldname in self._generated:
+            kwargs.setdefault(fieldname, None)
+        self._values = self._factory(**self._to_db(kwargs))
 
     def __str__(self):
         return '{model}<{values}>'.format(
@@ -498,40 +2179,378 @@ class Model(metaclass=BaseModel):
     def __eq__(self, other):
         return self._values == other._values
 
+    def _get_value(self, fieldname):
+        """
+        Return the value of a field for the current instance.
+
+        If the field has been deferred by the SelectQuery which loaded the instance, every
+        missing field is fetched at once before returning the value.
+        """
+        value = getattr(self._values, fieldname)
+
+        if value is DEFERRED:
+            self._load_deferred()
+            value = getattr(self._values, fieldname)
+
+        return value
+
+    def _load_deferred(self):
+        """Fetch all the deferred fields of the current instance in a single query."""
+        model = self.__class__
+        fields = [
+            getattr(model, fieldname)
+            for fieldname, value in zip(self._values._fields, self._values)
+            if value is DEFERRED
+        ]
+        query = SelectQuery(db=model._db).select(*fields).tables(model).where(*(
+            Expression(getattr(model, fieldname), SQLiteDB.EQ, Param(getattr(self._values, fieldname)))
+            for fieldname in model._primary_key
+        ))
+        row = query.dicts()[0]
+        self._values = self._values._replace(**row)
+
+    @classmethod
+    def _row(cls, values):
+        """Returns the stored values of an instance from a row of the database."""
+        for fieldname in cls._fieldnames:
+            if fieldname not in values:
+                raise AttributeError(
+                    "<{}> '{}' field is missing from the row.".format(cls.__name__, fieldname)
+                )
+
+        return cls._factory(**{
+            fieldname: value for fieldname, value in values.items() if fieldname in cls._fieldnames
+        })
+
+    @classmethod
+    def _to_db(cls, values):
+        """Convert the Python values of the provided fields to their database values."""
+        return {
+            fieldname: getattr(cls, fieldname).to_db(value) if fieldname in cls._fieldnames else value
+            for fieldname, value in values.items()
+        }
+
+    @classmethod
+    def _get_by_pk(cls, pk):
+        """Return the instance with the provided primary key, from memory if possible."""
+        return cls.where(cls.pk == pk)[0]
+
+    @classmethod
+    def _get_from_memory(cls, pk, session=None):
+        """Return the instance with the provided primary key from the session or the PKCache."""
+        if session is not None:
+            instance = session.get(cls, pk)
+            if instance is not None:
+                return instance
+
+        if cls.pk_cache is None:
+            return None
+
+        values = cls.pk_cache.get(pk)
+        if values is None:
+            return None
+
+        # Cached values are immutable, so they can be shared between instances.
+        instance = cls.__new__(cls)
+        instance._values = values
+
+        if session is not None:
+            session.add(instance)
+
+        return instance
+
+    @classmethod
+    def _hydrate(cls, values, session=None):
+        """
+        Return an instance from a row of the database.
+
+        If a session is provided, the instance already loaded for this row is returned
+        instead of a new one.
+        """
+        instance = session.get(cls, values.get('pk')) if session is not None else None
+
+        if instance is None:
+            # Rows hold database values, which don't need to be converted.
+            instance = cls.__new__(cls)
+            instance._values = cls._row(values)
+            if session is not None and values.get('pk') is not None:
+                session.add(instance)
+
+        return instance
+
     @classmethod
     def create(cls, **kwargs):
         """Return an instance of the related model."""
-        last_row_id = InsertQuery(cls._db).table(cls).from_dicts(kwargs).execute()
-        kwargs['pk'] = last_row_id
-        return cls(**kwargs)
+        instance = cls(**kwargs)
+        values = {
+            fieldname: getattr(instance._values, fieldname)
+            for fieldname in kwargs if fieldname not in cls._generated
+        }
+        last_row_id = InsertQuery(cls._db).table(cls).from_dicts(values).execute()
+        # Generated values are computed by SQLite: they are fetched on first access.
+        values = dict.fromkeys(cls._generated, DEFERRED)
+        if not cls._without_rowid:
+            values['pk'] = last_row_id
+        instance._values = instance._values._replace(**values)
+
+        # The identity map of a session is keyed by the rowid primary key.
+        if cls._db._session is not None and not cls._without_rowid:
+            cls._db._session.add(instance)
+
+        return instance
 
     @classmethod
     def create_many(cls, dicts):
-        InsertQuery(db=cls._db).table(cls).from_dicts(dicts).execute()
+        if not isinstance(dicts, list):
+            dicts = [dicts]
+
+        InsertQuery(db=cls._db).table(cls).from_dicts([cls._to_db(dct) for dct in dicts]).execute()
+
+    @classmethod
+    def _load(cls, records, parse, mapping, batch_size, progress, errors, keys=None):
+        """
+        Insert parsed records in batches, each batch inside its own savepoint.
+
+        The INSERT statement is built once, from the provided record keys, or from every field
+        of the model if records may have different keys, and each batch is sent to SQLite
+        with a single executemany call. A key missing from a record inserts the default
+        value of its field. If a batch fails and an 'errors' sink is provided, the batch is
+        replayed row by row and each failing row is sent to the sink as
+        errors(record_number, record, exception).
+        """
+        db = cls._db
+        mapping = mapping or {}
+        start = time.perf_counter()
+        fieldnames = cls._fieldnames if keys is None else {mapping.get(key, key) for key in keys}
+        fields = [
+            getattr(cls, fieldname)
+            for fieldname in sorted(fieldnames)
+            if fieldname in cls._fieldnames and fieldname not in cls._generated
+        ]
+        query = InsertQuery(db=db).table(cls).fields(*fields)
+        raw_query = query.build()
+        nrows = nrejected = 0
+        batch = []
+
+        def reject(number, record, error):
+            nonlocal nrejected
+            if errors is None:
+                raise error
+            nrejected += 1
+            errors(number, record, error)
+
+        def flush():
+            nonlocal nrows
+            try:
+                with db.savepoint('plume_load'):
+                    db.execute(raw_query, [row for _, _, row in batch])
+                nrows += len(batch)
+            except sqlite3.Error:
+                if errors is None:
+                    raise
+                with db.savepoint('plume_load'):
+                    for number, record, row in batch:
+                        try:
+                            db.execute(raw_query, [row])
+                            nrows += 1
+                        except sqlite3.Error as error:
+                            reject(number, record, error)
+
+            batch.clear()
+            db._invalidate(query)
+            if progress is not None:
+                progress(LoadReport(nrows, nrejected, time.perf_counter() - start))
+
+        for number, record in enumerate(records, start=1):
+            try:
+                record = parse(record)
+                values = {mapping.get(key, key): value for key, value in record.items()}
+                batch.append((number, record, [
+                    field.to_db(field.cast(values.get(field.name, field.default)))
+                    for field in fields
+                ]))
+            except (AttributeError, TypeError, ValueError) as error:
+                reject(number, record, error)
+
+            if len(batch) >= batch_size:
+                flush()
+
+        if batch:
+            flush()
+
+        return LoadReport(nrows, nrejected, time.perf_counter() - start)
 
     @classmethod
     def delete(cls, *args):
-        return DeleteQuery(db=self._db).table(cls).where(*args)
+        return DeleteQuery(db=cls._db).table(cls).where(*args)
+
+    @classmethod
+    def descendants(cls, root, via, max_depth=None):
+        """
+        Returns every descendant of a row in a hierarchy, with a single recursive query.
+
+        Descendants are returned level by level, then in primary key order. The hierarchy
+        must not contain cycles, unless a 'max_depth' is provided.
+
+        Args:
+            root: a model instance or a primary key.
+            via: the ForeignKeyField referencing the parent of each row.
+            max_depth: an optional number of levels to walk down: 1 only returns children.
+        """
+        if cls._without_rowid:
+            raise TypeError('Descendants of a WITHOUT ROWID model can not be walked by primary key.')
+
+        db = cls._db
+        name = 'descendants'
+        root = root.pk if isinstance(root, Model) else root
+
+        base = SelectQuery(db=db).select(cls.pk, '0').tables(cls).where(cls.pk == Param(root))
+        step = (
+            SelectQuery(db=db).select(cls.pk, name + '.depth + 1').tables(cls, name)
+            .where(Expression(via, SQLiteDB.EQ, name + '.pk'))
+        )
+        if max_depth is not None:
+            step = step.where(Expression(name + '.depth', SQLiteDB.LT, Param(max_depth)))
+
+        return (
+            SelectQuery(db=db).with_recursive(name, ('pk', 'depth'), base, step)
+            .select(*(getattr(cls, fieldname) for fieldname in sorted(cls._fieldnames)))
+            .tables(cls, name)
+            .where(cls.pk == name + '.pk', Expression(name + '.depth', SQLiteDB.GT, 0))
+            .order_by(name + '.depth', cls.pk)
+            .get()
+        )
+
+    @classmethod
+    def get_many(cls, pks):
+        """
+        Returns a dict mapping each found primary key to its model instance.
+
+        Instances available in the current session or in the PKCache of the model are not
+        queried. The other primary keys are bound as parameters of IN clauses, by chunks which
+        fit under the SQLite limit of parameters per statement.
+        """
+        if cls._without_rowid:
+            raise TypeError('Rows of a WITHOUT ROWID model can not be fetched by primary key.')
+
+        db = cls._db
+        session = db._session
+        instances = {}
+        missing = []
+
+        for pk in dict.fromkeys(pks):
+            instance = cls._get_from_memory(pk, session)
+            if instance is None:
+                missing.append(pk)
+            else:
+                instances[pk] = instance
+
+        chunk_size = db.variable_limit()
+        for start in range(0, len(missing), chunk_size):
+            chunk = BracketCSV(Param(pk) for pk in missing[start:start + chunk_size])
+            query = SelectQuery(db=db).tables(cls).where(Expression(cls.pk, SQLiteDB.IN, chunk))
+
+            for row in query.dicts():
+                instance = cls._hydrate(row, session)
+                instances[instance._values.pk] = instance
+                if cls.pk_cache is not None:
+                    cls.pk_cache.set(instance._values)
+
+        return instances
+
+    @classmethod
+    def load_csv(cls, path, mapping=None, batch_size=1000, progress=None, errors=None):
+        """
+        Bulk insert the rows of a CSV file, whose first line is a header.
+
+        Args:
+            path: path of the CSV file.
+            mapping: an optional dict mapping CSV column names to field names.
+            batch_size: number of rows inserted in each transaction.
+            progress: an optional callable receiving a LoadReport after each batch.
+            errors: an optional callable receiving (record_number, record, exception) for each
+                rejected row. If omitted, the first error is raised.
+
+        Returns:
+            A LoadReport with the number of inserted and rejected rows.
+        """
+        with open(path, newline='') as fileobj:
+            reader = csv.DictReader(fileobj)
+            return cls._load(
+                reader, lambda record: record,
+                mapping, batch_size, progress, errors, keys=reader.fieldnames or (),
+            )
+
+    @classmethod
+    def load_jsonl(cls, path, mapping=None, batch_size=1000, progress=None, errors=None):
+        """Bulk insert the objects of a JSON Lines file. See Model.load_csv for the arguments."""
+        with open(path) as fileobj:
+            return cls._load(
+                (line for line in fileobj if line.strip()), json.loads,
+                mapping, batch_size, progress, errors,
+            )
+
+    def open_blob(self, fieldname, readonly=True, size=None):
+        """
+        Open the value of a BlobField of the instance as a BlobIO file-like object.
+        Incremental blob I/O requires Python 3.11, and raises a NotImplementedError before.
+
+        Args:
+            fieldname: name of a BlobField of the model.
+            readonly: open the value for reading only.
+            size: if provided, the value is first replaced by 'size' zero bytes and opened for
+                writing, so a large payload can be streamed into it by chunks.
+        """
+        model = self.__class__
+        field = getattr(model, fieldname)
+        if not isinstance(field, BlobField):
+            raise TypeError("'{}' is not a BlobField.".format(fieldname))
+
+        if model._without_rowid:
+            raise TypeError('Blobs of a WITHOUT ROWID model can not be opened incrementally.')
+
+        if not hasattr(model._db._connection, 'blobopen'):
+            # Connection.blobopen is only available since Python 3.11.
+            raise NotImplementedError('Blobs can only be opened incrementally since Python 3.11.')
+
+        if size is not None:
+            readonly = False
+            UpdateQuery(db=model._db).table(model).fields(
+                field == fn.zeroblob(size)
+            ).where(model.pk == self.pk).execute()
+
+        if not readonly:
+            # The value loaded on this instance is about to be stale.
+            self._values = self._values._replace(**{fieldname: DEFERRED})
+
+        blob = model._db._connection.blobopen(
+            model.__name__.lower(), fieldname, self.pk, readonly=readonly
+        )
+        # Writes bypass SQLiteDB.build, so the row is invalidated once the blob is closed.
+        row = UpdateQuery(db=model._db).table(model).where(model.pk == self.pk)
+        return BlobIO(blob, readonly, on_close=lambda: model._db._invalidate(row))
 
     @classmethod
     def select(cls, *args):
-        return SelectQuery(db=cls._db).tables(cls).select(*args)
+        # A query built before the model is registered uses its database once executed.
+        return SelectQuery(db=getattr(cls, '_db', None)).tables(cls).select(*args)
 
     @classmethod
     def update(cls, *args):
-        return UpdateQuery(db=cls._db).table(model).fields(*args)
+        return UpdateQuery(db=cls._db).table(cls).fields(*args)
 
     @classmethod
     def where(cls, *args):
-        return SelectQuery(db=cls._db).tables(cls).where(*args)
+        return SelectQuery(db=getattr(cls, '_db', None)).tables(cls).where(*args)
 
 
 class CreateQuery:
-    __slots__ = ('_db', '_fields', '_table')
+    __slots__ = ('_db', '_fields', '_options', '_table')
 
     def __init__(self, db):
         self._db = db
         self._fields = []
+        self._options = []
         self._table = None
 
     def __str__(self):
@@ -549,13 +2568,30 @@ class CreateQuery:
 
     def fields(self, *fields):
         fields = sorted(fields, key=lambda field:field.name)
-        fields = [' '.join(field.sql()) for field in fields]
-        self._fields = BracketCSV(fields)
+        definitions = [' '.join(field.sql()) for field in fields]
+        for field in fields:
+            definitions.extend(field.generated_columns())
+        self._fields = BracketCSV(definitions)
         return self
 
     def from_model(self, model):
         fields = [getattr(model, fieldname) for fieldname in model._fieldnames]
-        return self.table(model.__name__).fields(*fields)
+        self.table(model.__name__).fields(*fields)
+
+        if model._without_rowid:
+            constraint = ' '.join((SQLiteDB.PK, str(BracketCSV(model._primary_key))))
+            self._fields = BracketCSV(self._fields + (constraint,))
+            self.options(SQLiteDB.WITHOUT_ROWID)
+
+        if model._strict:
+            self.options(SQLiteDB.STRICT)
+
+        return self
+
+    def options(self, *options):
+        """Add table options, like WITHOUT ROWID or STRICT."""
+        self._options.extend(options)
+        return self
 
 
 class FilterableQuery:
@@ -564,19 +2600,95 @@ class FilterableQuery:
     def __init__(self):
         self._filters = None
 
+    def _execute_in_batches(self, batch_size, pause, progress):
+        """
+        Execute the query on chunks of at most 'batch_size' rows, in primary key order.
+
+        Each chunk is bounded by the primary keys of its first and last rows and executed
+        in its own transaction, so the write lock is released between chunks and other
+        writers can interleave with a long purge or migration.
+
+        Args:
+            batch_size: maximum number of rows affected by each chunk.
+            pause: number of seconds to wait between two chunks.
+            progress: an optional callable receiving the number of rows affected so far.
+
+        Returns:
+            The total number of affected rows.
+        """
+        model = self._db._models.get(self._table.lower())
+        if model is not None and model._without_rowid:
+            raise TypeError('A WITHOUT ROWID table can not be processed in batches.')
+
+        pk = 'pk'
+        # Wrap the filters between brackets, as operators precedence is not handled.
+        filters = None if self._filters is None else Expression(BracketCSV([self._filters]))
+        last_pk = None
+        total = 0
+
+        while True:
+            select = SelectQuery(db=self._db).select(pk).tables(self._table)
+            select = select.order_by(pk).limit(batch_size)
+            if filters is not None:
+                select = select.where(filters)
+            if last_pk is not None:
+                select = select.where(Expression(pk, SQLiteDB.GT, last_pk))
+
+            pks = select.execute()
+            if not pks:
+                return total
+
+            low, high = pks[0][0], pks[-1][0]
+            chunk = copy.copy(self)
+            chunk._filters = filters
+            chunk.where(Expression(pk, SQLiteDB.BETWEEN, Expression(low, SQLiteDB.AND, high)))
+            total += self._db.build(chunk).rowcount
+            last_pk = high
+
+            if progress is not None:
+                progress(total)
+
+            if pause:
+                time.sleep(pause)
+
+    def _primary_key_filter(self, model):
+        """
+        Returns the primary key value if the query is only filtered on the primary key
+        of the provided model, otherwise returns None.
+        """
+        filters = self._filters
+
+        if (
+            isinstance(filters, Expression) and filters.op == SQLiteDB.EQ
+            and isinstance(filters.lo, PrimaryKeyField) and filters.lo.model is model
+            and isinstance(filters.ro, int)
+        ):
+            return filters.ro
+
+        return None
+
+    def params(self):
+        """Returns the values bound to the placeholders of the query."""
+        return collect_params(self._filters, [])
+
+    def _clone(self):
+        """Returns the query to modify: DELETE and UPDATE queries are modified in place."""
+        return self
+
     def where(self, *filters):
         if not len(filters):
             return self
 
+        query = self._clone()
         filters = list(filters)
 
-        if self._filters is None:
-            self._filters = filters.pop()
+        if query._filters is None:
+            query._filters = filters.pop()
 
         for expression in filters:
-            self._filters &= expression
+            query._filters &= expression
 
-        return self
+        return query
 
 
 class DeleteQuery(FilterableQuery):
@@ -594,7 +2706,16 @@ class DeleteQuery(FilterableQuery):
     def build(self):
         return self._db.build_delete(self)
 
-    def execute(self):
+    def execute(self, batch_size=None, pause=0, progress=None):
+        """
+        Delete the filtered rows.
+
+        If a 'batch_size' is provided, rows are deleted by chunks, each in its own transaction,
+        and the number of deleted rows is returned. See FilterableQuery._execute_in_batches.
+        """
+        if batch_size is not None:
+            return self._execute_in_batches(batch_size, pause, progress)
+
         self._db.build(self)
 
     def table(self, table):
@@ -616,7 +2737,9 @@ class DropQuery:
         return self._db.build_drop(self)
 
     def execute(self):
-        return self._db.build(self)
+        cursor = self._db.build(self)
+        self._db._drop_fts(self._table.lower())
+        return cursor
 
     def table(self, table):
         self._table = table if isinstance(table, str) else table.__name__
@@ -670,29 +2793,41 @@ class SelectQuery(FilterableQuery):
     A SelectQuery represents a Select-From-Where SQL query, and allow the user to define the WHERE
     clause. The user is allowed to add dynamically several criteria on a QuerySet. The SelectQuery only
     hit the database when it is iterated over or sliced.
+
+    A SelectQuery is immutable: each method returns a new query sharing the parts of its parent,
+    so a base query can be built once and specialized many times. The SQL output of a query is
+    compiled once, on its first use, and its expressions keep their own compiled output, so a
+    specialized query only compiles its new parts. A query built from a model before the model
+    is registered, at import time, runs on the database the model is registered to.
     """
     __slots__ = (
-        '_db', '_distinct', '_fields', '_limit', '_model',
-        '_offset', '_order_by', '_tables'
+        '_cached', '_ctes', '_db', '_deferred', '_distinct', '_fields', '_joins', '_limit',
+        '_model', '_offset', '_order_by', '_sql', '_tables', '_ttl'
     )
 
+    # Name of the column numbering the rows of each group in top_n_per_group().
+    RANK = 'plume_rank'
+
     def __init__(self, db):
         super().__init__()
+        self._cached = False
+        self._ctes = ()
         self._db = db
+        self._deferred = ()
         self._distinct = False
-        self._fields = []
+        self._fields = ()
+        self._joins = ()
         self._limit = None
+        self._model = None
         self._offset = None
-        self._order_by = []
-        self._tables = []
-
+        self._order_by = ()
+        self._sql = None
+        self._tables = ()
+        self._ttl = None
 
     def __str__(self):
         return ''.join(('(', self.build(), ')'))
 
-    def build(self):
-        return SQLiteDB.build_select(self)
-
     def __iter__(self):
         """
         Allow to iterate over a SelectQuery.
@@ -743,65 +2878,454 @@ class SelectQuery(FilterableQuery):
             offset = key
             direct_access = True
 
-        self.limit(limit)
-        self.offset(offset)
-
-        result = self.get()
+        result = self.limit(limit).offset(offset).get()
 
         return result[0] if direct_access else result
 
     def build(self):
-        return self._db.build_select(self)
+        if self._sql is None:
+            self._sql = self._database().build_select(self)
+
+        return self._sql
+
+    def _database(self):
+        """Returns the database of the query, or the one of its model when it was built unbound."""
+        return self._db if self._db is not None else (self._model or self._tables[0])._db
+
+    def _clone(self):
+        """Returns a copy of the query, sharing its immutable parts."""
+        query = copy.copy(self)
+        query._sql = None
+        return query
+
+    def _fetch(self):
+        """
+        Query the database and returns the column names and the rows of the result.
+
+        If the query is cached, the result is first looked up in the cache of the database.
+        Results are not stored while a transaction is opened, as it could be rolled back.
+        """
+        db = self._database()
+        raw_query = self.build()
+        params = self.params()
+        values = [params] if params else None
+
+        if not self._cached:
+            return db.fetch(raw_query, values)
+
+        key = (raw_query, tuple(params))
+        result = db.cache.get(key)
+
+        if result is None:
+            result = db.fetch(raw_query, values)
+            if not db._connection.in_transaction:
+                db.cache.set(key, self._read_tables(), result, self._ttl)
+
+        # Copy the rows so the caller can't alter the cached result.
+        return result[0], list(result[1])
+
+    def _primary_key_lookup(self):
+        """
+        Returns the primary key value if the query only fetches a whole row by primary key,
+        otherwise returns None.
+        """
+        if (
+            len(self._tables) != 1 or self._fields or self._joins or self._distinct
+            or self._order_by or self._offset or self._limit == 0
+        ):
+            return None
+
+        return self._primary_key_filter(self._tables[0])
+
+    def _read_tables(self):
+        """Returns the name of every table the query reads from, including subqueries."""
+        tables = {
+            (table if isinstance(table, str) else table.__name__).lower()
+            for table in self._tables if not isinstance(table, Alias)
+        }
+        tables.update(model.__name__.lower() for _, model, _ in self._joins)
+        nodes = [self._filters]
+        nodes.extend(table.node for table in self._tables if isinstance(table, Alias))
+        nodes.extend(on for _, _, on in self._joins)
+        for _, _, base, step in self._ctes:
+            nodes.extend((base, step))
+
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, SelectQuery):
+                tables |= node._read_tables()
+            elif isinstance(node, Expression):
+                nodes.extend((node.lo, node.ro))
+            elif isinstance(node, CSV):
+                nodes.extend(node)
+
+        return tables
+
+    @staticmethod
+    def _aliases(model):
+        """Returns the field names of a model with their column alias in a joined query."""
+        table = model.__name__.lower()
+        return [
+            (fieldname, '__'.join((table, fieldname))) for fieldname in sorted(model._fieldnames)
+        ]
+
+    def cached(self, ttl=None, max_entries=None):
+        """
+        Serve the result of the query from the cache of the database.
+
+        Cached results are evicted when one of the tables they read from is modified
+        through the database.
+
+        Args:
+            ttl: an optional number of seconds after which the cached result expires.
+            max_entries: an optional new capacity for the cache of the database.
+        """
+        query = self._clone()
+        query._cached = True
+        query._ttl = ttl
+
+        if max_entries is not None:
+            self._database().cache.resize(max_entries)
+
+        return query
 
     def dicts(self):
         """Query the database and returns the result as a list of dict"""
-        cursor = self._db.build(self, read_only=True)
-        rows = cursor.fetchall()
-        fields = [field[0] for field in cursor.description]
+        fields, rows = self._fetch()
         return [
             {field: value for field, value in zip(fields, row)}
             for row in rows
         ]
 
+    def defer(self, *fields):
+        """
+        Load every field of the model except the provided ones.
+
+        Deferred fields are fetched from the database the first time they are accessed
+        on a model instance.
+        """
+        deferred = {field if isinstance(field, str) else field.name for field in fields}
+        return self._load_only(
+            fieldname for fieldname in self._tables[0]._fieldnames if fieldname not in deferred
+        )
+
     def distinct(self, *fields):
-        self._distinct = True
-        self.select(*fields)
-        return self
+        query = self.select(*fields)
+        query._distinct = True
+        return query
 
     def execute(self):
         """Query the database and returns the result as a list of tuples."""
-        cursor = self._db.build(self, read_only=True)
-        return cursor.fetchall()
+        return self._fetch()[1]
 
     def exists(self):
-        return Expression(self._db.EXISTS, self)
+        return Expression(SQLiteDB.EXISTS, self)
+
+    def _export(self, write_header, write_rows, batch_size, progress):
+        """
+        Stream the result of the query to a writer, batch by batch.
+
+        Rows are fetched from the cursor 'batch_size' at a time, so the whole result is never
+        held in memory. After each batch, 'progress' is called with an ExportReport.
+        Compressed text columns of the model are exported decompressed.
+        """
+        start = time.perf_counter()
+        nrows = 0
+
+        with closing(self._database().build(self, read_only=True)) as cursor:
+            fields = [field[0] for field in cursor.description]
+            write_header(fields)
+            compressed = self._compressed_columns(fields)
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                if compressed:
+                    rows = [
+                        tuple(
+                            compressed[index].to_python(value) if index in compressed else value
+                            for index, value in enumerate(row)
+                        )
+                        for row in rows
+                    ]
+
+                write_rows(fields, rows)
+                nrows += len(rows)
+
+                if progress is not None:
+                    progress(ExportReport(nrows, time.perf_counter() - start))
+
+        return ExportReport(nrows, time.perf_counter() - start)
 
     def get(self):
-        """Returns a list of Model instances."""
+        """
+        Returns a list of Model instances.
+
+        A lookup by primary key is answered without querying the database when the instance
+        has already been loaded in the current session, or when the row is in the PKCache
+        of the model.
+        """
+        # A query reading from a subquery hydrates the model of the subquery.
+        model = self._model or self._tables[0]
+        session = self._database()._session
+        pk = None
+
+        if session is not None or model.pk_cache is not None:
+            pk = self._primary_key_lookup()
+
+        if pk is not None:
+            instance = model._get_from_memory(pk, session)
+            if instance is not None:
+                return [instance]
+
+        if self._joins:
+            return self._get_joined(session)
+
+        rows = self.dicts()
+
+        if self._deferred:
+            deferred = dict.fromkeys(self._deferred, DEFERRED)
+            for row in rows:
+                row.update(deferred)
+
+        instances = [model._hydrate(row, session) for row in rows]
+
+        if pk is not None and instances and model.pk_cache is not None and not self._deferred:
+            model.pk_cache.set(instances[0]._values)
+
+        return instances
+
+    def _compressed_columns(self, columns):
+        """Returns the compressed TextField of each column of the model, by column index."""
+        model = self._model or (self._tables[0] if self._tables else None)
+        if not isinstance(model, BaseModel):
+            return {}
+
+        fields = {
+            index: getattr(model, column) for index, column in enumerate(columns)
+            if column in model._fieldnames
+        }
+        return {
+            index: field for index, field in fields.items()
+            if isinstance(field, TextField) and field.compress is not None
+        }
+
+    def _get_joined(self, session):
+        """
+        Returns a list of tuples holding an instance of each model of a joined query.
+
+        The instance of a model missing from a row of a left join is None.
+        """
+        if self._fields:
+            # Like a query on a single model, every field is needed to hydrate instances.
+            raise AttributeError(
+                'A joined query with selected fields can only return dicts or tuples.'
+            )
+
+        models = self._models()
+        aliases = [self._aliases(model) for model in models]
+        result = []
+
+        for row in self.dicts():
+            instances = []
+            for model, model_aliases in zip(models, aliases):
+                values = {fieldname: row[alias] for fieldname, alias in model_aliases}
+                if all(values[fieldname] is None for fieldname in model._primary_key):
+                    instances.append(None)
+                else:
+                    instances.append(model._hydrate(values, session))
+            result.append(tuple(instances))
+
+        return result
+
+    def join(self, model, on, kind='inner'):
+        """
+        Join the rows of another model, matched by the 'on' expression.
+
+        Args:
+            model: the joined Model subclass.
+            on: the join condition, ex: Pokemon.trainer == Trainer.pk
+            kind: 'inner' to only keep matching rows, or 'left' to keep every row of the
+                previous tables.
+
+        The get() method then returns a tuple of instances for each row, and the dicts()
+        method prefixes each column with the name of its table: pokemon__name.
+        """
+        if kind not in SQLiteDB.JOIN:
+            raise ValueError("Unknown join kind '{}'.".format(kind))
+
+        query = self._clone()
+        query._joins = self._joins + ((kind, model, on),)
+        return query
+
+    def _load_only(self, fieldnames):
         model = self._tables[0]
-        return [model(**d) for d in self.dicts()]
+        # The primary key is always loaded to be able to fetch deferred fields later on.
+        fieldnames = set(fieldnames) | set(model._primary_key)
+        query = self.select(*(
+            getattr(model, fieldname) for fieldname in model._fieldnames if fieldname in fieldnames
+        ))
+        query._deferred = tuple(
+            fieldname for fieldname in model._fieldnames if fieldname not in fieldnames
+        )
+        return query
 
     def limit(self, limit:int):
         """ Slice a SelectQuery without hiting the database."""
-        self._limit = limit
-        return self
+        query = self._clone()
+        query._limit = limit
+        return query
 
     def offset(self, offset:int):
-        self._offset = offset
-        return self
+        query = self._clone()
+        query._offset = offset
+        return query
+
+    def only(self, *fields):
+        """
+        Load only the provided fields of the model, plus its primary key.
+
+        Other fields are fetched from the database the first time they are accessed
+        on a model instance.
+        """
+        return self._load_only(field if isinstance(field, str) else field.name for field in fields)
+
+    def top_n_per_group(self, n, partition_by, order_by):
+        """
+        Returns a query keeping the first 'n' rows of each group, in a single pass.
+
+        The current query is wrapped in a subquery numbering the rows of each group with
+        row_number(), and only the rows numbered up to 'n' are returned, group by group.
+
+        Args:
+            n: number of rows kept in each group.
+            partition_by: fields, or a single field, defining the groups.
+            order_by: fields or sort strings, or a single one, ordering the rows of each group.
+        """
+        model = self._tables[0]
+        table = model.__name__.lower()
+        window = Function('row_number').over(partition_by=partition_by, order_by=order_by)
+        ranked = self.select(table + '.' + SQLiteDB.ALL, window.alias(self.RANK))
+
+        query = (
+            SelectQuery(db=self._db)
+            .select(*(getattr(model, fieldname) for fieldname in sorted(model._fieldnames)))
+            .tables(Alias(ranked, table))
+            .where(Expression(self.RANK, SQLiteDB.LE, Param(n)))
+            .order_by(*(window.partition_by + (self.RANK,)))
+        )
+        query._model = model
+        return query
+
+    def _full_text_indexes(self):
+        """Returns the FTS5 index of each model searched by the filters or the order of the query."""
+        indexes = {}
+        nodes = [self._filters, CSV(self._order_by)]
+
+        while nodes:
+            node = nodes.pop(0)
+            if isinstance(node, FullTextIndex):
+                indexes.setdefault(node.model, FullTextIndex(node.model))
+            elif isinstance(node, Expression):
+                nodes.extend((node.lo, node.op, node.ro))
+            elif isinstance(node, Function):
+                nodes.extend(node.args)
+            elif isinstance(node, CSV):
+                nodes.extend(node)
+
+        return list(indexes.values())
+
+    def _models(self):
+        """Returns the queried model followed by every joined model."""
+        return [self._model or self._tables[0]] + [model for _, model, _ in self._joins]
 
     def order_by(self, *fields):
-        self._order_by.extend(field if isinstance(field, str) else str(field) for field in fields)
-        return self
+        query = self._clone()
+        # Expressions are kept as nodes, as they can hold parameters.
+        query._order_by = self._order_by + tuple(
+            field if isinstance(field, (str, Expression)) else str(field) for field in fields
+        )
+        return query
+
+    def params(self):
+        """Returns the values bound to the placeholders of the query, in their SQL order."""
+        params = []
+        for _, _, base, step in self._ctes:
+            params.extend(base.params())
+            params.extend(step.params())
+
+        for table in self._tables:
+            collect_params(table, params)
+
+        for _, _, on in self._joins:
+            collect_params(on, params)
+
+        collect_params(self._filters, params)
+        return collect_params(CSV(self._order_by), params)
 
     def select(self, *fields):
         # Allow to filter Select-Query on columns.
-        self._fields.extend(field if isinstance(field, str) else str(field) for field in fields)
-        return self
+        query = self._clone()
+        query._fields = self._fields + tuple(
+            field if isinstance(field, str) else str(field) for field in fields
+        )
+        return query
 
     def tables(self, *tables):
-        self._tables.extend(tables)
-        return self
+        query = self._clone()
+        query._tables = self._tables + tables
+        return query
+
+    def to_csv(self, fileobj, batch_size=1000, progress=None):
+        """
+        Write the result of the query as CSV into a file object, with a header row.
+
+        Returns:
+            An ExportReport with the number of written rows and the export throughput.
+        """
+        writer = csv.writer(fileobj)
+        return self._export(
+            write_header=writer.writerow,
+            write_rows=lambda fields, rows: writer.writerows(rows),
+            batch_size=batch_size,
+            progress=progress,
+        )
+
+    def to_jsonl(self, fileobj, batch_size=1000, progress=None):
+        """
+        Write the result of the query as JSON Lines into a file object, one object per row.
+
+        Returns:
+            An ExportReport with the number of written rows and the export throughput.
+        """
+        def write_rows(fields, rows):
+            fileobj.writelines(json.dumps(dict(zip(fields, row))) + '\n' for row in rows)
+
+        return self._export(
+            write_header=lambda fields: None,
+            write_rows=write_rows,
+            batch_size=batch_size,
+            progress=progress,
+        )
+
+    def with_recursive(self, name, columns, base, step):
+        """
+        Declare a recursive common table expression, which the query can read as a table.
+
+        The rows of 'base' initialize the table, then 'step' is run on the rows it added
+        last, until it doesn't return any new row.
+
+        Args:
+            name: name of the common table expression.
+            columns: names of its columns.
+            base: a SelectQuery returning the initial rows.
+            step: a SelectQuery reading the table 'name' and returning the next rows.
+        """
+        query = self._clone()
+        query._ctes = self._ctes + ((name, tuple(columns), base, step),)
+        return query
 
 
 class UpdateQuery(FilterableQuery):
@@ -819,18 +3343,32 @@ class UpdateQuery(FilterableQuery):
     def build(self):
         return self._db.build_update(self)
 
-    def execute(self):
+    def execute(self, batch_size=None, pause=0, progress=None):
+        """
+        Update the filtered rows.
+
+        If a 'batch_size' is provided, rows are updated by chunks, each in its own transaction,
+        and the number of updated rows is returned. See FilterableQuery._execute_in_batches.
+        """
+        if batch_size is not None:
+            return self._execute_in_batches(batch_size, pause, progress)
+
         return self._db.build(self)
 
     def fields(self, *args):
-        # Remove table name in each Expression left operand.
-        for expression in args:
-            if isinstance(expression.lo, Field):
-                expression.lo = expression.lo.name
-
-        self._fields.extend(args)
+        # Remove table name in each Expression left operand, without altering the
+        # expression itself, which can be shared.
+        self._fields.extend(
+            Expression(expression.lo.name, expression.op, expression.ro)
+            if isinstance(expression.lo, Field) else expression
+            for expression in args
+        )
         return self
 
+    def params(self):
+        """Returns the values bound to the placeholders of the SET and WHERE clauses."""
+        return collect_params(self._filters, collect_params(CSV(self._fields), []))
+
     def table(self, table):
         self._table = table if isinstance(table, str) else table.__name__
         return self
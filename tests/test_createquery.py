@@ -13,7 +13,7 @@ class TestCreateAPI:
             CreateQuery(self.db).__dict__
 
     def test_attributes(self):
-        expected = ('_db', '_fields', '_table')
+        expected = ('_db', '_fields', '_options', '_table')
         result = CreateQuery(self.db).__slots__
         assert result == expected
 
@@ -59,3 +59,41 @@ class TestDeleteQueryWhere(BaseTestCase):
         ).fetchone()[0]
         assert nrows == 2
 
+
+class TestDeleteQueryBatches(BaseTestCase):
+
+    def count(self):
+        return Trainer._db._connection.execute('SELECT count(*) FROM trainer').fetchone()[0]
+
+    def test_delete_all_rows_by_batches(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie', 'Giovanni', 'James'])
+        deleted = DeleteQuery(self.db).table(Trainer).execute(batch_size=2)
+        assert deleted == 5
+        assert self.count() == 0
+
+    def test_delete_filtered_rows_by_batches(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie', 'Giovanni', 'James'])
+        deleted = DeleteQuery(self.db).table(Trainer).where(
+            (Trainer.name == 'James') | (Trainer.name == 'Jessie')
+        ).execute(batch_size=2)
+        assert deleted == 3
+        names = Trainer._db._connection.execute('SELECT name FROM trainer').fetchall()
+        assert names == [('Giovanni',), ('Giovanni',)]
+
+    def test_each_batch_runs_in_its_own_transaction(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        statements = []
+        self.db._connection.set_trace_callback(statements.append)
+        DeleteQuery(self.db).table(Trainer).execute(batch_size=2)
+        assert statements.count('COMMIT') == 2
+
+    def test_delete_by_batches_reports_progress(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        progress = []
+        DeleteQuery(self.db).table(Trainer).execute(batch_size=2, progress=progress.append)
+        assert progress == [2, 3]
+
+    def test_model_delete_returns_a_filtered_delete_query(self):
+        self.add_trainer(['Giovanni', 'James'])
+        Trainer.delete(Trainer.name == 'James').execute()
+        assert self.count() == 1
@@ -1,10 +1,21 @@
 from plume.plume import (
-    Field, ForeignKeyField, FloatField, IntegerField,
-    Model, PrimaryKeyField, SQLiteDB, TextField,
+    BlobField, DateTimeField, EnumField, Field, ForeignKeyField, FloatField, GeneratedField,
+    IntegerField, JSONField, Model, PrimaryKeyField, SQLiteDB, TextField,
 )
 from utils import Attack, Pokemon, Trainer
 
+from datetime import datetime, timedelta, timezone
+import enum
+import io
+import json
 import pytest
+import sqlite3
+import sys
+
+
+class Status(enum.IntEnum):
+    PENDING = 0
+    DONE = 1
 
 
 class TestField:
@@ -178,6 +189,25 @@ class TestIntegerField:
         expected = 'trainer.age BETWEEN 17 AND 42'
         assert str(expression) == expected
 
+    def test_allows_arithmetic_operators(self):
+        assert str(self.User.field + 1) == "(user.field + 1)"
+        assert str(self.User.field - 1) == "(user.field - 1)"
+        assert str(self.User.field * 2) == "(user.field * 2)"
+        assert str(self.User.field / 2) == "(user.field / 2)"
+
+    def test_allows_reflected_arithmetic_operators(self):
+        assert str(10 - self.User.field) == "(10 - user.field)"
+        assert str(2 * self.User.field + 1) == "((2 * user.field) + 1)"
+
+    def test_allows_min_max_and_coalesce_functions(self):
+        assert str(self.User.field.max(0)) == "max(user.field, 0)"
+        assert str(self.User.field.min(10, 20)) == "min(user.field, 10, 20)"
+        assert str(self.User.field.coalesce(0)) == "coalesce(user.field, 0)"
+
+    def test_arithmetic_operation_can_be_compared(self):
+        criterion = (self.User.field + 1 > 42)
+        assert str(criterion) == "(user.field + 1) > 42"
+
 class TestPrimaryKeyField:
 
     def test_is_slotted(self):
@@ -248,3 +278,473 @@ class TestTextField:
         expression = Trainer.name.between('A', 'Z')
         expected = "trainer.name BETWEEN 'A' AND 'Z'"
         assert str(expression) == expected
+
+    def test_quotes_are_escaped(self):
+        criterion = (self.User.field == "Farfetch'd")
+        assert str(criterion) == "user.field = 'Farfetch''d'"
+
+    def test_allows_coalesce_and_max_functions(self):
+        assert str(self.User.field.coalesce('x')) == "coalesce(user.field, 'x')"
+        assert str(self.User.field.max("O'Neil")) == "max(user.field, 'O''Neil')"
+
+    def test_coalesce_matches_the_provided_string(self):
+        db = SQLiteDB(':memory:')
+        db.register(Trainer)
+        Trainer.create(name='James', age=21)
+        query = Trainer.select().where(Trainer.name.coalesce('x') == 'James')
+        assert len(query.get()) == 1
+
+    def test_allows_concat_operator(self):
+        criterion = self.User.field.concat('!').concat("'")
+        assert str(criterion) == "((user.field || '!') || '''')"
+
+
+class TestCompressedTextField:
+
+    class Article(Model):
+        body = TextField(compress='zlib', threshold=16)
+
+    def setup_method(self):
+        self.db = SQLiteDB(':memory:')
+        self.db.register(self.Article)
+
+    def test_small_values_are_stored_as_text(self):
+        self.Article.create(body='short')
+        stored = self.db._connection.execute('SELECT typeof(body), body FROM article').fetchone()
+        assert stored == ('text', 'short')
+
+    def test_large_values_are_stored_compressed(self):
+        body = 'Pika pika! ' * 100
+        self.Article.create(body=body)
+        stored = self.db._connection.execute('SELECT body FROM article').fetchone()[0]
+        assert isinstance(stored, bytes) and len(stored) < len(body)
+        assert self.Article.select().get()[0].body == body
+
+    def test_large_values_are_compressed_when_updated(self):
+        self.Article.create(body='short')
+        body = 'Pika pika! ' * 100
+        self.Article.update(self.Article.body == body).where(self.Article.pk == 1).execute()
+        stored = self.db._connection.execute('SELECT typeof(body) FROM article').fetchone()[0]
+        assert stored == 'blob'
+        assert self.Article.select().get()[0].body == body
+
+    def test_large_values_are_exported_decompressed(self):
+        body = 'Pika pika! ' * 100
+        self.Article.create(body=body)
+        output = io.StringIO()
+        self.Article.select().to_jsonl(output)
+        assert json.loads(output.getvalue()) == {'body': body, 'pk': 1}
+        output = io.StringIO()
+        self.Article.select(self.Article.body).to_csv(output)
+        assert output.getvalue().splitlines() == ['body', body]
+
+    def test_incompressible_values_are_stored_as_text(self):
+        field = TextField(compress='zlib', threshold=4)
+        assert field.to_db('abcdefgh') == 'abcdefgh'
+
+    def test_unknown_codec(self):
+        with pytest.raises(ValueError):
+            TextField(compress='lz4')
+
+    def test_compressed_field_is_not_searchable(self):
+        with pytest.raises(TypeError):
+            TextField(compress='zlib', searchable=True)
+
+    def test_compression_options_are_keyword_only(self):
+        with pytest.raises(TypeError):
+            TextField(None, None, True, False, False, 'zlib', 16)
+
+
+# Connection.blobopen is only available since Python 3.11.
+requires_blobopen = pytest.mark.skipif(sys.version_info < (3, 11), reason='requires Python 3.11')
+
+
+class TestBlobField:
+
+    class Document(Model):
+        content = BlobField()
+
+    def setup_method(self):
+        self.db = SQLiteDB(':memory:')
+        self.db.register(self.Document)
+
+    def test_is_slotted(self):
+        with pytest.raises(AttributeError):
+            BlobField().__dict__
+
+    def test_sqlite_type_is_BLOB(self):
+        assert BlobField.sqlite_datatype == 'BLOB'
+
+    def test_accepts_bytes_like_values(self):
+        field = BlobField()
+        assert field.is_valid(b'data') is True
+        assert field.is_valid(bytearray(b'data')) is True
+        with pytest.raises(TypeError):
+            field.is_valid('data')
+
+    @requires_blobopen
+    def test_read_blob_by_chunks(self):
+        document = self.Document.create(content=b'0123456789')
+        with document.open_blob('content') as blob:
+            assert len(blob) == 10
+            assert blob.read(4) == b'0123'
+            blob.seek(8)
+            assert blob.read() == b'89'
+
+    @requires_blobopen
+    def test_read_blob_into_a_buffer(self):
+        document = self.Document.create(content=b'0123456789')
+        buffer = bytearray(6)
+        with document.open_blob('content') as blob:
+            assert blob.readinto(buffer) == 6
+        assert buffer == b'012345'
+
+    @requires_blobopen
+    def test_blob_is_read_only_by_default(self):
+        document = self.Document.create(content=b'0123456789')
+        with document.open_blob('content') as blob:
+            assert blob.writable() is False
+            with pytest.raises(sqlite3.OperationalError):
+                blob.write(b'x')
+
+    @requires_blobopen
+    def test_write_blob_by_chunks_after_resizing(self):
+        document = self.Document.create(content=b'')
+        with document.open_blob('content', size=6) as blob:
+            blob.write(b'abc')
+            blob.write(b'def')
+        assert document.content == b'abcdef'
+
+    @requires_blobopen
+    def test_writing_a_blob_invalidates_cached_rows(self):
+        document = self.Document.create(content=b'aaaa')
+        query = self.Document.select().cached()
+        assert query.get()[0].content == b'aaaa'
+        with self.db.session():
+            loaded = self.Document.where(self.Document.pk == 1)[0]
+            with document.open_blob('content', readonly=False) as blob:
+                blob.write(b'bbbb')
+            assert self.Document.where(self.Document.pk == 1)[0] is not loaded
+        assert query.get()[0].content == b'bbbb'
+
+    @pytest.mark.skipif(sys.version_info >= (3, 11), reason='requires Python < 3.11')
+    def test_open_blob_is_not_implemented_before_python_3_11(self):
+        document = self.Document.create(content=b'aaaa')
+        with pytest.raises(NotImplementedError):
+            document.open_blob('content')
+
+    def test_open_blob_on_another_field_type(self):
+        with pytest.raises(TypeError):
+            Trainer(name='Giovanni', age=42).open_blob('name')
+
+
+class TestSearchableTextField:
+
+    class Article(Model):
+        title = TextField(searchable=True)
+        body = TextField(searchable=True)
+        author = TextField()
+
+    def setup_method(self):
+        self.db = SQLiteDB(':memory:')
+        self.db.register(self.Article)
+        self.Article.create(title='Pikachu', body='An electric mouse', author='Ash')
+        self.Article.create(title='Raichu', body='Pikachu evolves into Raichu', author='Ash')
+        self.Article.create(title='Meowth', body="Team Rocket's cat", author='James')
+
+    def test_is_not_searchable_by_default(self):
+        assert TextField().searchable is False
+
+    def test_first_positional_argument_is_the_default(self):
+        field = TextField('Sacha')
+        assert field.default == 'Sacha'
+        assert field.searchable is False
+
+    def test_searchable_is_keyword_only(self):
+        with pytest.raises(TypeError):
+            TextField(None, None, True, False, True)
+
+    def test_match_filters_rows(self):
+        titles = [
+            article.title
+            for article in self.Article.select().where(self.Article.body.match('pikachu')).get()
+        ]
+        assert titles == ['Raichu']
+
+    def test_bm25_orders_rows_by_relevance(self):
+        titles = [
+            article.title for article in self.Article.select()
+            .where(self.Article.body.match('pikachu OR raichu OR mouse'))
+            .order_by(self.Article.body.bm25()).get()
+        ]
+        assert titles == ['Raichu', 'Pikachu']
+
+    def test_bm25_can_order_rows_by_descending_relevance(self):
+        query = (
+            self.Article.select()
+            .where(self.Article.body.match('pikachu OR raichu OR mouse'))
+            .order_by(self.Article.body.bm25().desc())
+        )
+        assert query.params() == ['pikachu OR raichu OR mouse']
+        assert [article.title for article in query.get()] == ['Pikachu', 'Raichu']
+
+    def test_search_joins_the_full_text_index_once(self):
+        query = (
+            self.Article.select()
+            .where(self.Article.body.match('pikachu'))
+            .order_by(self.Article.body.bm25())
+        )
+        expected = (
+            'SELECT article.* FROM article INNER JOIN article_fts ON article_fts.rowid = article.pk '
+            'WHERE article_fts.body MATCH ? ORDER BY bm25(article_fts)'
+        )
+        assert query.build() == expected
+
+    def test_index_follows_updates_and_deletes(self):
+        self.Article.update(self.Article.body == 'A cat').where(self.Article.title == 'Raichu').execute()
+        self.Article.delete(self.Article.title == 'Meowth').execute()
+        assert self.Article.select().where(self.Article.body.match('pikachu')).get() == []
+        titles = [a.title for a in self.Article.select().where(self.Article.body.match('cat')).get()]
+        assert titles == ['Raichu']
+
+    def test_existing_rows_are_indexed_when_registered_again(self):
+        self.db.register(self.Article)
+        result = self.Article.select().where(self.Article.title.match('meowth')).get()
+        assert len(result) == 1
+
+    def test_index_is_dropped_and_created_again_with_the_table(self):
+        self.db.drop(self.Article).execute()
+        tables = self.db._connection.execute(
+            "SELECT name FROM sqlite_master WHERE name LIKE 'article%'"
+        ).fetchall()
+        assert tables == []
+        self.db.register(self.Article)
+        self.Article.create(title='Ditto', body='goodbye', author='Ash')
+        assert [a.title for a in self.Article.select().where(self.Article.body.match('goodbye')).get()] == ['Ditto']
+        assert self.Article.select().where(self.Article.body.match('mouse')).get() == []
+
+    def test_missing_triggers_are_created_again(self):
+        self.db._connection.execute('DROP TRIGGER article_fts_INSERT')
+        self.db.register(self.Article)
+        self.Article.create(title='Ditto', body='goodbye', author='Ash')
+        assert len(self.Article.select().where(self.Article.body.match('goodbye')).get()) == 1
+
+    def test_match_on_a_field_which_is_not_searchable(self):
+        with pytest.raises(TypeError):
+            self.Article.author.match('Ash')
+        with pytest.raises(TypeError):
+            self.Article.author.bm25()
+
+    def test_match_on_several_fields(self):
+        query = self.Article.select().where(
+            self.Article.title.match('raichu') & self.Article.body.match('pikachu')
+        )
+        assert [article.title for article in query.get()] == ['Raichu']
+
+
+class TestJSONField:
+
+    class Event(Model):
+        kind = TextField()
+        payload = JSONField(indexes=['user.id'])
+
+    def setup_method(self):
+        self.db = SQLiteDB(':memory:')
+        self.db.register(self.Event)
+        self.Event.create(kind='login', payload={'user': {'id': 5, 'name': 'Ash'}, 'tags': ['a']})
+        self.Event.create(kind='login', payload={'user': {'id': 7, 'name': 'Misty'}, 'tags': []})
+
+    def test_is_slotted(self):
+        with pytest.raises(AttributeError):
+            JSONField().__dict__
+
+    def test_indexed_path_keys_must_be_identifiers(self):
+        with pytest.raises(TypeError):
+            JSONField(indexes=['user-id'])
+        with pytest.raises(TypeError):
+            JSONField(indexes=[('user', 'first name')])
+        assert JSONField(indexes=[('tags', 0)]).indexes == (('tags', 0),)
+
+    def test_values_are_stored_as_compact_json(self):
+        stored = self.db._connection.execute('SELECT payload FROM event').fetchone()[0]
+        assert stored == '{"user":{"id":5,"name":"Ash"},"tags":["a"]}'
+
+    def test_values_are_decoded_when_read(self):
+        event = self.Event.select().where(self.Event.pk == 1).get()[0]
+        assert event.payload == {'user': {'id': 5, 'name': 'Ash'}, 'tags': ['a']}
+        assert self.Event(kind='logout', payload=[1, 2]).payload == [1, 2]
+
+    def test_document_is_changed_by_assigning_a_new_document(self):
+        event = self.Event.select().where(self.Event.pk == 1).get()[0]
+        event.payload['tags'] = ['b']
+        assert event.payload['tags'] == ['a']
+        event.payload = dict(event.payload, tags=['b'])
+        assert event.payload == {'user': {'id': 5, 'name': 'Ash'}, 'tags': ['b']}
+
+    def test_path_outputs_json_extract(self):
+        criterion = self.Event.payload['user']['name'] == "O'Neil"
+        assert str(criterion) == "json_extract(event.payload, '$.user.name') = 'O''Neil'"
+        assert str(self.Event.payload['tags'][0]) == "json_extract(event.payload, '$.tags[0]')"
+
+    def test_indexed_path_outputs_its_generated_column(self):
+        assert str(self.Event.payload['user']['id'] == 5) == 'event.payload__user__id = 5'
+
+    def test_filter_on_a_path(self):
+        events = self.Event.select().where(self.Event.payload['user']['name'] == 'Misty').get()
+        assert [event.pk for event in events] == [2]
+
+    def test_filter_on_an_indexed_path_uses_the_index(self):
+        query = self.Event.select().where(self.Event.payload['user']['id'] == 5)
+        assert [event.pk for event in query.get()] == [1]
+        plan = self.db._connection.execute('EXPLAIN QUERY PLAN ' + query.build()).fetchall()
+        assert 'event_payload__user__id' in plan[0][-1]
+
+    def test_update_a_document(self):
+        self.Event.update(self.Event.payload == {'user': None}).where(self.Event.pk == 2).execute()
+        assert self.Event.select().where(self.Event.pk == 2).get()[0].payload == {'user': None}
+
+    def test_value_needs_to_be_serializable(self):
+        with pytest.raises(TypeError):
+            JSONField(default={'date': object()})
+
+
+class TestGeneratedField:
+
+    class Player(Model):
+        name = TextField()
+        score = IntegerField()
+        normalized_name = GeneratedField('lower(name)', index=True)
+        bucket = GeneratedField('score / 10', stored=False)
+
+    def setup_method(self):
+        self.db = SQLiteDB(':memory:')
+        self.db.register(self.Player)
+
+    def test_is_slotted(self):
+        with pytest.raises(AttributeError):
+            GeneratedField('1').__dict__
+
+    def test_is_not_required(self):
+        assert GeneratedField('1').required is False
+
+    def test_for_create_table_query_sql_output_a_list_of_keywords(self):
+        field = GeneratedField('lower(name)')
+        field.name = 'field'
+        assert field.sql() == ['field', 'GENERATED ALWAYS AS', '(lower(name))', 'STORED']
+        field = GeneratedField('lower(name)', stored=False)
+        field.name = 'field'
+        assert field.sql() == ['field', 'GENERATED ALWAYS AS', '(lower(name))', 'VIRTUAL']
+
+    def test_values_are_computed_on_write(self):
+        player = self.Player.create(name='Ash', score=42)
+        assert player.normalized_name == 'ash'
+        assert player.bucket == 4
+        player = self.Player.select().where(self.Player.normalized_name == 'ash').get()[0]
+        assert (player.name, player.normalized_name) == ('Ash', 'ash')
+
+    def test_filter_on_an_indexed_field_uses_the_index(self):
+        query = self.Player.select().where(self.Player.normalized_name == 'ash')
+        plan = self.db._connection.execute('EXPLAIN QUERY PLAN ' + query.build()).fetchall()
+        assert 'player_normalized_name' in plan[0][-1]
+
+    def test_values_are_computed_by_bulk_inserts(self):
+        self.Player.create_many([{'name': 'Misty', 'score': 7}, {'name': 'Brock', 'score': 12}])
+        buckets = self.Player.select(self.Player.bucket).order_by(self.Player.name).execute()
+        assert buckets == [(1,), (0,)]
+
+
+class TestDateTimeField:
+
+    class Task(Model):
+        due = DateTimeField()
+        status = EnumField(Status)
+
+    def setup_method(self):
+        self.db = SQLiteDB(':memory:')
+        self.db.register(self.Task)
+
+    def test_is_slotted(self):
+        with pytest.raises(AttributeError):
+            DateTimeField().__dict__
+
+    def test_sqlite_type_is_INTEGER(self):
+        assert DateTimeField.sqlite_datatype == 'INTEGER'
+
+    def test_values_are_stored_as_epoch_microseconds(self):
+        self.Task.create(due=datetime(1970, 1, 2, 0, 0, 0, 5), status=Status.PENDING)
+        stored = self.db._connection.execute('SELECT due FROM task').fetchone()[0]
+        assert stored == 86400000005
+
+    def test_aware_datetimes_are_converted_to_utc(self):
+        due = datetime(2020, 1, 1, 12, tzinfo=timezone(timedelta(hours=2)))
+        task = self.Task(due=due, status=Status.PENDING)
+        assert task.due == datetime(2020, 1, 1, 10)
+
+    def test_values_are_converted_when_read(self):
+        due = datetime(2020, 5, 17, 8, 30, 15, 123456)
+        self.Task.create(due=due, status=Status.DONE)
+        task = self.Task.select().get()[0]
+        assert task.due == due
+
+    def test_between_compares_integers(self):
+        expression = self.Task.due.between(datetime(1970, 1, 1), datetime(1970, 1, 1, 0, 0, 1))
+        assert str(expression) == 'task.due BETWEEN 0 AND 1000000'
+
+    def test_filter_and_order_by_datetime(self):
+        for day in (3, 1, 2):
+            self.Task.create(due=datetime(2020, 1, day), status=Status.PENDING)
+        tasks = (
+            self.Task.select().where(self.Task.due >= datetime(2020, 1, 2))
+            .order_by(self.Task.due).get()
+        )
+        assert [task.due.day for task in tasks] == [2, 3]
+
+    def test_setter_converts_the_value(self):
+        task = self.Task(due=datetime(2020, 1, 1), status=Status.PENDING)
+        task.due = datetime(2021, 1, 1)
+        assert task.due == datetime(2021, 1, 1)
+
+
+class TestEnumField:
+
+    class Task(Model):
+        status = EnumField(Status, default=Status.PENDING)
+
+    def setup_method(self):
+        self.db = SQLiteDB(':memory:')
+        self.db.register(self.Task)
+
+    def test_is_slotted(self):
+        with pytest.raises(AttributeError):
+            EnumField(Status).__dict__
+
+    def test_for_create_table_query_sql_output_a_list_of_keywords(self):
+        field = EnumField(Status, default=Status.DONE)
+        field.name = 'field'
+        assert field.sql() == ['field', 'INTEGER', 'NOT NULL', 'DEFAULT', '1']
+
+    def test_members_need_integer_values(self):
+        Color = enum.Enum('Color', {'RED': 'red'})
+        with pytest.raises(TypeError):
+            EnumField(Color)
+
+    def test_value_needs_to_be_a_member(self):
+        with pytest.raises(TypeError):
+            EnumField(Status, default=1)
+
+    def test_values_are_stored_as_integers(self):
+        self.Task.create(status=Status.DONE)
+        assert self.db._connection.execute('SELECT status FROM task').fetchone()[0] == 1
+        assert self.Task.select().get()[0].status is Status.DONE
+
+    def test_filter_on_a_member(self):
+        self.Task.create(status=Status.DONE)
+        self.Task.create(status=Status.PENDING)
+        criterion = self.Task.status == Status.PENDING
+        assert str(criterion) == 'task.status = 0'
+        assert [task.pk for task in self.Task.select().where(criterion).get()] == [2]
+
+    def test_cast_accepts_names_and_values(self):
+        assert self.Task.status.cast('DONE') is Status.DONE
+        assert self.Task.status.cast('0') is Status.PENDING
+        assert self.Task.status.cast('') is None
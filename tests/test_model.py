@@ -1,4 +1,7 @@
-from plume.plume import DeleteQuery, Model, SelectQuery, SQLiteDB, UpdateQuery
+from plume.plume import (
+    DeleteQuery, ForeignKeyField, IntegerField, Model, PrimaryKeyField, SelectQuery, SQLiteDB,
+    TextField, UpdateQuery,
+)
 
 from utils import BaseTestCase, Pokemon, Trainer
 
@@ -95,8 +98,269 @@ class TestModelResult(BaseTestCase):
         assert trainers[1][1] == 21
 
 
-            
-        
-        
+class TestModelBulkLoad(BaseTestCase):
+
+    class Gym(Model):
+        name = TextField()
+        city = TextField(required=False)
+        badges = IntegerField(default=1)
+
+    def write(self, tmp_path, filename, content):
+        path = tmp_path / filename
+        path.write_text(content)
+        return str(path)
+
+    def count_trainers(self):
+        return Trainer._db._connection.execute('SELECT count(*) FROM trainer').fetchone()[0]
+
+    def test_load_csv_converts_values_to_field_types(self, tmp_path):
+        path = self.write(tmp_path, 'trainers.csv', 'name,age\nGiovanni,42\nJames,21\n')
+        report = Trainer.load_csv(path)
+        assert report.rows == 2
+        assert report.rejected == 0
+        trainers = Trainer._db._connection.execute('SELECT name, age FROM trainer').fetchall()
+        assert trainers == [('Giovanni', 42), ('James', 21)]
+
+    def test_load_csv_with_mapping(self, tmp_path):
+        path = self.write(tmp_path, 'trainers.csv', 'Name,Age,Ignored\nGiovanni,42,x\n')
+        Trainer.load_csv(path, mapping={'Name': 'name', 'Age': 'age'})
+        trainers = Trainer._db._connection.execute('SELECT name, age FROM trainer').fetchall()
+        assert trainers == [('Giovanni', 42)]
+
+    def test_load_jsonl(self, tmp_path):
+        path = self.write(tmp_path, 'trainers.jsonl', '{"name": "Giovanni", "age": 42}\n\n{"name": "James", "age": "21"}\n')
+        report = Trainer.load_jsonl(path)
+        assert report.rows == 2
+        assert self.count_trainers() == 2
+
+    def test_load_jsonl_keeps_keys_missing_from_the_first_record(self, tmp_path):
+        self.db.register(self.Gym)
+        path = self.write(tmp_path, 'gyms.jsonl', '\n'.join((
+            '{"name": "Pewter"}',
+            '{"name": "Cerulean", "city": "Nantes", "badges": 2}',
+        )))
+        report = self.Gym.load_jsonl(path)
+        assert report == (2, 0, report.seconds)
+        gyms = self.db._connection.execute('SELECT name, city, badges FROM gym').fetchall()
+        assert gyms == [('Pewter', None, 1), ('Cerulean', 'Nantes', 2)]
+
+    def test_rejected_first_record_does_not_fix_the_loaded_keys(self, tmp_path):
+        path = self.write(tmp_path, 'trainers.jsonl', '\n'.join((
+            '{"age": "old"}',
+            '{"name": "James", "age": 21}',
+        )))
+        rejected = []
+        report = Trainer.load_jsonl(path, errors=lambda number, record, error: rejected.append(number))
+        assert (report.rows, report.rejected) == (1, 1)
+        assert rejected == [1]
+
+    def test_load_csv_uses_the_header_as_keys(self, tmp_path):
+        self.db.register(self.Gym)
+        path = self.write(tmp_path, 'gyms.csv', 'name,city\nPewter,\nCerulean,Nantes\n')
+        self.Gym.load_csv(path)
+        gyms = self.db._connection.execute('SELECT name, city, badges FROM gym').fetchall()
+        assert gyms == [('Pewter', '', 1), ('Cerulean', 'Nantes', 1)]
+
+    def test_load_reports_progress_after_each_batch(self, tmp_path):
+        path = self.write(tmp_path, 'trainers.csv', 'name,age\nGiovanni,42\nJames,21\nJessie,17\n')
+        reports = []
+        Trainer.load_csv(path, batch_size=2, progress=reports.append)
+        assert [report.rows for report in reports] == [2, 3]
+
+    def test_load_raises_on_invalid_row_without_error_sink(self, tmp_path):
+        path = self.write(tmp_path, 'trainers.csv', 'name,age\nGiovanni,old\n')
+        with pytest.raises(ValueError):
+            Trainer.load_csv(path)
+
+    def test_load_sends_invalid_rows_to_error_sink(self, tmp_path):
+        path = self.write(tmp_path, 'trainers.jsonl', '\n'.join((
+            '{"name": "Giovanni", "age": "old"}',
+            '{"name": "James", "age": 21}',
+            '{"age": 17}',
+            '{"name": "Jessie", "age": 17}',
+        )))
+        rejected = []
+        report = Trainer.load_jsonl(path, errors=lambda number, record, error: rejected.append(number))
+        assert report.rows == 2
+        assert report.rejected == 2
+        assert rejected == [1, 3]
+        assert self.count_trainers() == 2
+
+
+class TestModelGetMany(BaseTestCase):
+
+    def setup_method(self):
+        super().setup_method()
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        self.statements = []
+        self.db._connection.set_trace_callback(self.statements.append)
+
+    def test_get_many_returns_a_dict_of_instances_by_primary_key(self):
+        result = Trainer.get_many([3, 1])
+        assert sorted(result) == [1, 3]
+        assert result[1].name == 'Giovanni'
+        assert result[3].name == 'Jessie'
+
+    def test_get_many_ignores_missing_primary_keys(self):
+        assert list(Trainer.get_many([2, 42])) == [2]
+
+    def test_get_many_runs_a_single_in_query(self):
+        Trainer.get_many([1, 2])
+        assert self.statements == ['SELECT * FROM trainer WHERE trainer.pk IN (1, 2)']
+
+    def test_get_many_splits_primary_keys_under_the_parameters_limit(self):
+        self.db._connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 2)
+        result = Trainer.get_many([1, 2, 3, 3])
+        assert len(result) == 3
+        assert len(self.statements) == 2
+
+    def test_get_many_reuses_session_instances(self):
+        with self.db.session():
+            james = Trainer.where(Trainer.pk == 2)[0]
+            del self.statements[:]
+            result = Trainer.get_many([2])
+        assert result[2] is james
+        assert self.statements == []
+
+
+class TestModelTableOptions:
+
+    class Log(Model):
+        message = TextField(compress='zlib', threshold=8)
+
+        class Meta:
+            autoincrement = False
+            strict = True
+
+    class Translation(Model):
+        key = TextField()
+        language = TextField()
+        text = TextField()
+
+        class Meta:
+            primary_key = ('key', 'language')
+            without_rowid = True
+
+    def setup_method(self):
+        self.db = SQLiteDB(':memory:')
+        self.db.register(self.Log, self.Translation)
+
+    def test_create_strict_table_without_autoincrement(self):
+        expected = (
+            'CREATE TABLE IF NOT EXISTS log (message ANY NOT NULL, pk INTEGER PRIMARY KEY) STRICT'
+        )
+        assert self.db.create().from_model(self.Log).build() == expected
+
+    def test_autoincrement_is_keyword_only(self):
+        assert PrimaryKeyField(autoincrement=False).autoincrement is False
+        with pytest.raises(TypeError):
+            PrimaryKeyField(False)
+
+    def test_no_sequence_is_maintained_without_autoincrement(self):
+        log = self.Log.create(message='Pikachu used Thunderbolt! ' * 10)
+        assert log.pk == 1
+        assert self.Log.where(self.Log.pk == 1)[0].message == log.message
+        tables = self.db._connection.execute("SELECT name FROM sqlite_master").fetchall()
+        assert ('sqlite_sequence',) not in tables
+
+    def test_strict_table_rejects_values_of_another_type(self):
+        with pytest.raises(sqlite3.IntegrityError):
+            self.db._connection.execute("INSERT INTO log (message, pk) VALUES ('x', 'a')")
+
+    def test_create_table_without_rowid(self):
+        expected = (
+            'CREATE TABLE IF NOT EXISTS translation (key TEXT NOT NULL, language TEXT NOT NULL, '
+            'text TEXT NOT NULL, PRIMARY KEY (key, language)) WITHOUT ROWID'
+        )
+        assert self.db.create().from_model(self.Translation).build() == expected
+
+    def test_model_without_rowid_has_no_pk_field(self):
+        assert 'pk' not in self.Translation._fieldnames
+
+    def test_create_and_select_without_rowid(self):
+        self.Translation.create(key='hello', language='fr', text='bonjour')
+        self.Translation.create(key='hello', language='en', text='hello')
+        with pytest.raises(sqlite3.IntegrityError):
+            self.Translation.create(key='hello', language='fr', text='salut')
+
+        query = self.Translation.where(self.Translation.language == 'fr').defer('text')
+        translation = query.get()[0]
+        assert translation.text == 'bonjour'
+
+    def test_features_relying_on_pk_are_not_supported_without_rowid(self):
+        with pytest.raises(TypeError):
+            self.Translation.get_many(['hello'])
+        with pytest.raises(TypeError):
+            self.Translation.descendants('hello', via=self.Translation.key)
+        with pytest.raises(TypeError):
+            class Label(Model):
+                translation = ForeignKeyField(self.Translation, 'labels')
+
+    def test_without_rowid_needs_a_primary_key(self):
+        with pytest.raises(TypeError):
+            class Setting(Model):
+                name = TextField()
+
+                class Meta:
+                    without_rowid = True
+
+    def test_primary_key_needs_existing_fields(self):
+        with pytest.raises(TypeError):
+            class Setting(Model):
+                name = TextField()
+
+                class Meta:
+                    primary_key = ('value',)
+                    without_rowid = True
+
+
+class Category(Model):
+    name = TextField()
+    parent = ForeignKeyField('self', 'children', required=False)
+
+
+class TestModelDescendants:
+
+    def setup_method(self):
+        self.db = SQLiteDB(':memory:')
+        self.db.register(Category)
+        pokemon = Category.create(name='Pokemon', parent=None)
+        fire = Category.create(name='Fire', parent=pokemon)
+        water = Category.create(name='Water', parent=pokemon)
+        Category.create(name='Charmander', parent=fire)
+        Category.create(name='Squirtle', parent=water)
+        Category.create(name='Digimon', parent=None)
+        self.statements = []
+        self.db._connection.set_trace_callback(self.statements.append)
+
+    def test_foreign_key_can_reference_its_own_model(self):
+        assert Category.parent.related_model is Category
+        assert Category.where(Category.name == 'Fire')[0].parent.name == 'Pokemon'
+        assert Category.where(Category.name == 'Pokemon')[0].parent is None
+
+    def test_descendants_are_returned_level_by_level_in_one_query(self):
+        descendants = Category.descendants(1, via=Category.parent)
+        assert [category.name for category in descendants] == [
+            'Fire', 'Water', 'Charmander', 'Squirtle',
+        ]
+        assert len(self.statements) == 1
+        assert self.statements[0].startswith('WITH RECURSIVE descendants(pk, depth) AS (')
+
+    def test_descendants_up_to_a_maximum_depth(self):
+        root = Category.where(Category.pk == 1)[0]
+        descendants = Category.descendants(root, via=Category.parent, max_depth=1)
+        assert [category.name for category in descendants] == ['Fire', 'Water']
 
+    def test_leaf_has_no_descendants(self):
+        assert Category.descendants(4, via=Category.parent) == []
 
+    def test_with_recursive_builds_a_common_table_expression(self):
+        base = SelectQuery(self.db).select('1')
+        step = SelectQuery(self.db).select('n + 1').tables('counter').where('n < 5')
+        query = self.db.with_recursive('counter', ('n',), base, step).select('n').tables('counter')
+        expected = (
+            'WITH RECURSIVE counter(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM counter WHERE n < 5) '
+            'SELECT n FROM counter'
+        )
+        assert query.build() == expected
+        assert query.execute() == [(1,), (2,), (3,), (4,), (5,)]
@@ -0,0 +1,111 @@
+from plume.plume import (
+    DeleteQuery, ForeignKeyField, IntegerField, Model, PKCache,
+    SQLiteDB, TextField, UpdateQuery,
+)
+from utils import DB_NAME
+
+import pytest
+
+
+class Region(Model):
+    name = TextField()
+
+    class Meta:
+        pk_cache = 2
+
+
+class City(Model):
+    name = TextField()
+    region = ForeignKeyField(Region, 'cities')
+
+
+class TestPKCacheAPI:
+
+    def test_is_slotted(self):
+        with pytest.raises(AttributeError):
+            PKCache(Region, 10).__dict__
+
+    def test_is_enabled_by_meta_option(self):
+        assert isinstance(Region.pk_cache, PKCache) is True
+        assert Region.pk_cache.max_entries == 2
+
+    def test_is_disabled_by_default(self):
+        assert City.pk_cache is None
+
+    def test_meta_is_not_a_model_attribute(self):
+        assert hasattr(Region, 'Meta') is False
+
+
+class TestPKCacheLookups:
+
+    def setup_method(self):
+        self.db = SQLiteDB(DB_NAME)
+        self.db.register(Region, City)
+        self.statements = []
+        self.db._connection.set_trace_callback(self.statements.append)
+        for name in ('Kanto', 'Johto', 'Hoenn'):
+            Region.create(name=name)
+
+    def test_lookup_by_primary_key_is_served_from_cache(self):
+        assert Region.where(Region.pk == 1)[0].name == 'Kanto'
+        del self.statements[:]
+        assert Region.where(Region.pk == 1)[0].name == 'Kanto'
+        assert self.statements == []
+        assert Region.pk_cache.stats() == (1, 1, 0, 1)
+        assert Region.pk_cache.hit_rate == 0.5
+
+    def test_foreign_key_lookup_is_served_from_cache(self):
+        City.create(name='Pallet Town', region=1)
+        city = City.where(City.pk == 1)[0]
+        assert city.region.name == 'Kanto'
+        del self.statements[:]
+        assert city.region.name == 'Kanto'
+        assert self.statements == []
+
+    def test_other_queries_are_not_cached(self):
+        Region.where(Region.name == 'Kanto').get()
+        assert len(Region.pk_cache) == 0
+
+    def test_least_recently_used_rows_are_evicted(self):
+        for pk in (1, 2, 3):
+            Region.where(Region.pk == pk)[0]
+        assert len(Region.pk_cache) == 2
+        assert Region.pk_cache.evictions == 1
+        assert Region.pk_cache.get(1) is None
+
+    def test_update_by_primary_key_evicts_the_row(self):
+        Region.where(Region.pk == 1)[0]
+        Region.where(Region.pk == 2)[0]
+        UpdateQuery(self.db).table(Region).fields(Region.name == 'Sinnoh').where(Region.pk == 1).execute()
+        assert Region.pk_cache.get(1) is None
+        assert Region.pk_cache.get(2) is not None
+        assert Region.where(Region.pk == 1)[0].name == 'Sinnoh'
+
+    def test_rows_read_in_a_rolled_back_transaction_are_not_cached(self):
+        with pytest.raises(ValueError):
+            with self.db.atomic():
+                UpdateQuery(self.db).table(Region).fields(Region.name == 'Johto').where(Region.pk == 1).execute()
+                assert Region.where(Region.pk == 1)[0].name == 'Johto'
+                assert Region.get_many([1])[1].name == 'Johto'
+                raise ValueError
+        assert Region.pk_cache.get(1) is None
+        assert Region.where(Region.pk == 1)[0].name == 'Kanto'
+
+    def test_filtered_delete_clears_the_cache(self):
+        Region.where(Region.pk == 1)[0]
+        DeleteQuery(self.db).table(Region).where(Region.name == 'Kanto').execute()
+        assert len(Region.pk_cache) == 0
+
+    def test_warm_loads_rows_until_the_cache_is_full(self):
+        assert Region.pk_cache.warm() == 2
+        assert len(Region.pk_cache) == 2
+        assert Region.pk_cache.memory_usage() > 0
+
+    def test_warm_loads_provided_primary_keys(self):
+        assert Region.pk_cache.warm([3]) == 1
+        assert Region.pk_cache.get(3).name == 'Hoenn'
+
+    def test_registering_clears_the_cache(self):
+        Region.pk_cache.warm()
+        SQLiteDB(DB_NAME).register(Region)
+        assert len(Region.pk_cache) == 0
@@ -1,7 +1,9 @@
 from plume import *
-from plume.plume import InsertQuery, SelectQuery
+from plume.plume import DEFERRED, DeleteQuery, InsertQuery, SelectQuery, UpdateQuery
 from utils import Attack, BaseTestCase, Pokemon, Trainer
 
+import io
+import json
 import pytest
 
 class TestSelectQueryAPI(BaseTestCase):
@@ -12,8 +14,8 @@ class TestSelectQueryAPI(BaseTestCase):
 
     def test_attributes(self):
         expected = (
-            '_db', '_distinct', '_fields', '_limit', '_model',
-            '_offset', '_order_by', '_tables'
+            '_cached', '_ctes', '_db', '_deferred', '_distinct', '_fields', '_joins', '_limit',
+            '_model', '_offset', '_order_by', '_sql', '_tables', '_ttl'
         )
         result = SelectQuery(self.db).__slots__
         assert result == expected
@@ -288,6 +290,24 @@ class TestSelectQueryWhere(BaseTestCase):
         assert jessie.name == 'Jessie'
         assert jessie.age == 17
 
+    def test_IN_operator_with_many_values_binds_a_json_array(self):
+        query = SelectQuery(db=self.db).tables(Trainer).where(Trainer.age >> range(100))
+        assert query.build() == 'SELECT * FROM trainer WHERE trainer.age IN (SELECT value FROM json_each(?))'
+        assert query.params() == [json.dumps(list(range(100)))]
+
+    def test_filter_with_IN_operator_with_many_values(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        names = ['Trainer{}'.format(i) for i in range(100)] + ['James', 'Jessie']
+        result = SelectQuery(db=self.db).tables(Trainer).select(Trainer.name).where(Trainer.name >> names).execute()
+        assert result == [('James',), ('Jessie',)]
+
+    def test_exists_subquery_with_many_IN_values(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        self.add_pokemon(['Koffing'])
+        subquery = Pokemon.select().where(Pokemon.level >> range(100), Pokemon.trainer == Trainer.pk)
+        result = Trainer.where(subquery.exists()).get()
+        assert [trainer.name for trainer in result] == ['James']
+
     def test_IN_operator_filter_with_query(self):
         self.add_trainer(['Giovanni', 'James', 'Jessie'])
         self.add_pokemon(['Kangaskhan', 'Koffing', 'Wobbuffet'])
@@ -471,3 +491,323 @@ class TestSelectQueryOrderBy(BaseTestCase):
             .order_by(Trainer.name.asc(), Trainer.age.desc()).execute()
         )
         assert result == [('Giovanni', 66), ('Giovanni', 42), ('Jessie', 17)]
+
+
+class TestSelectQueryDeferredFields(BaseTestCase):
+
+    def test_only_selects_provided_fields_and_primary_key(self):
+        query = SelectQuery(self.db).tables(Trainer).only(Trainer.name).build()
+        assert query.startswith('SELECT ')
+        assert set(query[len('SELECT '):query.index(' FROM')].split(', ')) == {
+            'trainer.name', 'trainer.pk'
+        }
+
+    def test_defer_selects_all_fields_except_provided_ones(self):
+        query = SelectQuery(self.db).tables(Trainer).defer(Trainer.name).build()
+        assert 'trainer.name' not in query
+        assert 'trainer.age' in query
+        assert 'trainer.pk' in query
+
+    def test_only_returns_model_instances(self):
+        self.add_trainer(['Giovanni', 'James'])
+        result = SelectQuery(self.db).tables(Trainer).only(Trainer.name).get()
+        assert len(result) == 2
+        for element in result:
+            assert isinstance(element, Trainer) is True
+        assert result[0].name == 'Giovanni'
+        assert result[1].name == 'James'
+
+    def test_deferred_field_is_loaded_on_access(self):
+        self.add_trainer(['Giovanni', 'James'])
+        james = SelectQuery(self.db).tables(Trainer).defer('age').where(Trainer.name == 'James')[0]
+        assert james._values.age is DEFERRED
+        assert james.age == 21
+        assert james._values.age == 21
+
+    def test_all_deferred_fields_are_loaded_at_once(self):
+        self.add_trainer('Giovanni')
+        giovanni = SelectQuery(self.db).tables(Trainer).only()[0]
+        assert giovanni.pk == 1
+        assert giovanni.name == 'Giovanni'
+        assert giovanni._values.age == 42
+
+    def test_deferred_foreign_key_is_loaded_on_access(self):
+        self.add_trainer('Giovanni')
+        self.add_pokemon('Kangaskhan')
+        kangaskhan = SelectQuery(self.db).tables(Pokemon).only(Pokemon.name)[0]
+        assert kangaskhan.trainer.name == 'Giovanni'
+
+
+class TestSelectQueryExport(BaseTestCase):
+
+    def test_to_csv_writes_header_and_rows(self):
+        self.add_trainer(['Giovanni', 'James'])
+        output = io.StringIO()
+        SelectQuery(self.db).select(Trainer.name, Trainer.age).tables(Trainer).to_csv(output)
+        assert output.getvalue().splitlines() == ['name,age', 'Giovanni,42', 'James,21']
+
+    def test_to_jsonl_writes_one_object_per_row(self):
+        self.add_trainer(['Giovanni', 'James'])
+        output = io.StringIO()
+        SelectQuery(self.db).select(Trainer.name, Trainer.age).tables(Trainer).to_jsonl(output)
+        result = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert result == [{'name': 'Giovanni', 'age': 42}, {'name': 'James', 'age': 21}]
+
+    def test_export_returns_a_report(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        report = SelectQuery(self.db).tables(Trainer).to_jsonl(io.StringIO())
+        assert report.rows == 3
+        assert report.rows_per_second >= 0
+
+    def test_export_reports_progress_after_each_batch(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        reports = []
+        SelectQuery(self.db).tables(Trainer).to_csv(io.StringIO(), batch_size=2, progress=reports.append)
+        assert [report.rows for report in reports] == [2, 3]
+
+
+class TestSelectQueryCache(BaseTestCase):
+
+    def test_cached_query_hits_the_cache_on_second_execution(self):
+        self.add_trainer(['Giovanni', 'James'])
+        first = SelectQuery(self.db).tables(Trainer).cached().get()
+        second = SelectQuery(self.db).tables(Trainer).cached().get()
+        assert first == second
+        assert self.db.cache.stats() == (1, 1, 0, 1)
+
+    def test_uncached_query_does_not_use_the_cache(self):
+        self.add_trainer('Giovanni')
+        SelectQuery(self.db).tables(Trainer).get()
+        assert self.db.cache.stats() == (0, 0, 0, 0)
+
+    def test_cached_result_can_not_be_altered_by_the_caller(self):
+        self.add_trainer('Giovanni')
+        SelectQuery(self.db).tables(Trainer).cached().execute().clear()
+        assert len(SelectQuery(self.db).tables(Trainer).cached().execute()) == 1
+
+    def test_insert_invalidates_cached_queries_on_the_table(self):
+        self.add_trainer('Giovanni')
+        assert len(SelectQuery(self.db).tables(Trainer).cached().get()) == 1
+        self.add_trainer('James')
+        assert len(SelectQuery(self.db).tables(Trainer).cached().get()) == 2
+
+    def test_update_and_delete_invalidate_cached_queries_on_the_table(self):
+        self.add_trainer('Giovanni')
+        query = lambda: SelectQuery(self.db).select(Trainer.age).tables(Trainer).cached()
+        assert query().execute() == [(42,)]
+        UpdateQuery(self.db).table(Trainer).fields(Trainer.age == 43).execute()
+        assert query().execute() == [(43,)]
+        DeleteQuery(self.db).table(Trainer).execute()
+        assert query().execute() == []
+
+    def test_writes_invalidate_cached_queries_reading_the_table_in_a_subquery(self):
+        self.add_trainer('Giovanni')
+        self.add_pokemon('Kangaskhan')
+        giovanni = SelectQuery(self.db).select(Trainer.pk).tables(Trainer).where(Trainer.name == 'Giovanni')
+        query = lambda: SelectQuery(self.db).tables(Pokemon).where(Pokemon.trainer >> giovanni).cached()
+        assert len(query().get()) == 1
+        UpdateQuery(self.db).table(Trainer).fields(Trainer.name == 'Jessie').execute()
+        assert len(query().get()) == 0
+
+    def test_writes_on_other_tables_keep_cached_queries(self):
+        self.add_trainer('Giovanni')
+        SelectQuery(self.db).tables(Trainer).cached().get()
+        self.add_attack('Rage')
+        SelectQuery(self.db).tables(Trainer).cached().get()
+        assert self.db.cache.hits == 1
+
+    def test_cached_result_expires_after_ttl(self):
+        self.add_trainer('Giovanni')
+        SelectQuery(self.db).tables(Trainer).cached(ttl=-1).get()
+        SelectQuery(self.db).tables(Trainer).cached(ttl=-1).get()
+        assert self.db.cache.hits == 0
+        assert self.db.cache.misses == 2
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.add_trainer(['Giovanni', 'James'])
+        SelectQuery(self.db).tables(Trainer).where(Trainer.age > 18).cached(max_entries=1).get()
+        SelectQuery(self.db).tables(Trainer).cached().get()
+        assert self.db.cache.stats() == (0, 2, 1, 1)
+
+
+class TestSelectQueryJoin(BaseTestCase):
+
+    def setup_method(self):
+        super().setup_method()
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        self.add_pokemon(['Kangaskhan', 'Koffing'])
+
+    def test_join_outputs_aliased_columns(self):
+        query = Trainer.select().join(Pokemon, on=Pokemon.trainer == Trainer.pk)
+        expected = (
+            'SELECT trainer.age AS trainer__age, trainer.name AS trainer__name, '
+            'trainer.pk AS trainer__pk, pokemon.level AS pokemon__level, '
+            'pokemon.name AS pokemon__name, pokemon.pk AS pokemon__pk, '
+            'pokemon.trainer AS pokemon__trainer '
+            'FROM trainer INNER JOIN pokemon ON pokemon.trainer = trainer.pk'
+        )
+        assert query.build() == expected
+
+    def test_inner_join_returns_tuples_of_instances(self):
+        rows = (
+            Trainer.select().join(Pokemon, on=Pokemon.trainer == Trainer.pk)
+            .order_by(Trainer.pk).get()
+        )
+        assert [(trainer.name, pokemon.name) for trainer, pokemon in rows] == [
+            ('Giovanni', 'Kangaskhan'), ('James', 'Koffing'),
+        ]
+
+    def test_left_join_returns_none_for_missing_rows(self):
+        rows = (
+            Trainer.select().join(Pokemon, on=Pokemon.trainer == Trainer.pk, kind='left')
+            .where(Trainer.name == 'Jessie').get()
+        )
+        assert len(rows) == 1
+        assert rows[0][0].name == 'Jessie'
+        assert rows[0][1] is None
+
+    def test_join_returns_prefixed_dicts(self):
+        rows = (
+            Trainer.select().join(Pokemon, on=Pokemon.trainer == Trainer.pk)
+            .where(Pokemon.level > 10).dicts()
+        )
+        assert len(rows) == 1
+        assert rows[0]['trainer__name'] == 'Giovanni'
+        assert rows[0]['pokemon__name'] == 'Kangaskhan'
+
+    def test_join_instances_share_the_session(self):
+        with self.db.session():
+            giovanni = Trainer.where(Trainer.pk == 1)[0]
+            rows = Trainer.select().join(Pokemon, on=Pokemon.trainer == Trainer.pk).get()
+        assert rows[0][0] is giovanni
+
+    def test_join_with_selected_fields_can_not_return_instances(self):
+        query = Trainer.select(Trainer.name, Pokemon.name).join(Pokemon, on=Pokemon.trainer == Trainer.pk)
+        with pytest.raises(AttributeError):
+            query.get()
+        with pytest.raises(AttributeError):
+            Trainer.select().join(Pokemon, on=Pokemon.trainer == Trainer.pk).only('name').get()
+        assert len(query.execute()) == 2
+
+    def test_unknown_join_kind(self):
+        with pytest.raises(ValueError):
+            Trainer.select().join(Pokemon, on=Pokemon.trainer == Trainer.pk, kind='cross')
+
+    def test_cached_join_is_invalidated_by_writes_on_the_joined_table(self):
+        query = Trainer.select().join(Pokemon, on=Pokemon.trainer == Trainer.pk).cached()
+        assert len(query.get()) == 2
+        self.add_pokemon(['Wobbuffet'])
+        assert len(query.get()) == 3
+
+
+class TestSelectQueryWindowFunctions(BaseTestCase):
+
+    def setup_method(self):
+        super().setup_method()
+        self.add_trainer(['Giovanni', 'James'])
+        Pokemon.create_many([
+            {'name': 'Kangaskhan', 'level': 29, 'trainer': 1},
+            {'name': 'Persian', 'level': 40, 'trainer': 1},
+            {'name': 'Rhyhorn', 'level': 12, 'trainer': 1},
+            {'name': 'Koffing', 'level': 9, 'trainer': 2},
+        ])
+
+    def test_window_function_output(self):
+        window = fn.row_number().over(partition_by=Pokemon.trainer, order_by=Pokemon.level.desc())
+        expected = 'row_number() OVER (PARTITION BY pokemon.trainer ORDER BY pokemon.level DESC)'
+        assert str(window) == expected
+        assert str(fn.rank().over(order_by=[Pokemon.level]).alias('r')) == (
+            'rank() OVER (ORDER BY pokemon.level) AS r'
+        )
+
+    def test_select_window_functions(self):
+        result = (
+            Pokemon.select(
+                Pokemon.name,
+                fn.rank().over(partition_by=Pokemon.trainer, order_by=Pokemon.level.desc()).alias('r'),
+                fn.sum(Pokemon.level).over(order_by=Pokemon.pk).alias('running'),
+                fn.lag(Pokemon.name, 1).over(order_by=Pokemon.pk).alias('previous'),
+            )
+            .order_by(Pokemon.pk).dicts()
+        )
+        assert [(row['name'], row['r'], row['running'], row['previous']) for row in result] == [
+            ('Kangaskhan', 2, 29, None),
+            ('Persian', 1, 69, 'Kangaskhan'),
+            ('Rhyhorn', 3, 81, 'Persian'),
+            ('Koffing', 1, 90, 'Rhyhorn'),
+        ]
+
+    def test_top_n_per_group_returns_model_instances(self):
+        query = Pokemon.select().where(Pokemon.level > 10).top_n_per_group(
+            2, partition_by=Pokemon.trainer, order_by=Pokemon.level.desc()
+        )
+        pokemons = query.get()
+        assert [pokemon.name for pokemon in pokemons] == ['Persian', 'Kangaskhan']
+        assert all(isinstance(pokemon, Pokemon) for pokemon in pokemons)
+
+    def test_top_n_per_group_runs_a_single_query(self):
+        statements = []
+        self.db._connection.set_trace_callback(statements.append)
+        pokemons = Pokemon.select().top_n_per_group(
+            1, partition_by=Pokemon.trainer, order_by=Pokemon.level.desc()
+        ).get()
+        assert [pokemon.name for pokemon in pokemons] == ['Persian', 'Koffing']
+        assert len(statements) == 1
+
+
+class TestSelectQueryImmutability(BaseTestCase):
+
+    def setup_method(self):
+        super().setup_method()
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+
+    def test_methods_return_a_new_query(self):
+        base = Trainer.select()
+        filtered = base.where(Trainer.age > 18)
+        assert filtered is not base
+        assert base.build() == 'SELECT * FROM trainer'
+        assert filtered.build() == 'SELECT * FROM trainer WHERE trainer.age > 18'
+        assert base.order_by(Trainer.name).limit(1).offset(1).build() == (
+            'SELECT * FROM trainer ORDER BY trainer.name LIMIT 1 OFFSET 1'
+        )
+        assert base.build() == 'SELECT * FROM trainer'
+
+    def test_base_query_can_be_indexed_many_times(self):
+        base = Trainer.select().order_by(Trainer.pk)
+        assert [base[index].name for index in range(3)] == ['Giovanni', 'James', 'Jessie']
+        assert len(base.get()) == 3
+
+    def test_base_query_can_be_specialized_many_times(self):
+        base = Trainer.select(Trainer.name)
+        assert base.where(Trainer.age > 18).execute() == [('Giovanni',), ('James',)]
+        assert base.where(Trainer.age < 18).execute() == [('Jessie',)]
+
+    def test_sql_is_compiled_once(self):
+        query = Trainer.select().where(Trainer.age > 18)
+        assert query.build() is query.build()
+
+    def test_compiled_fragments_are_shared_between_queries(self):
+        base = Trainer.select().where(Trainer.age > 18)
+        base.build()
+        fragment = base._filters._sql
+        specialized = base.where(Trainer.name != 'James').limit(1)
+        assert specialized.build() == (
+            "SELECT * FROM trainer WHERE trainer.age > 18 AND trainer.name != 'James' LIMIT 1"
+        )
+        assert specialized._filters.lo._sql is fragment
+
+    def test_query_built_before_the_model_is_registered(self):
+
+        class Gym(Model):
+            name = TextField()
+
+        base = Gym.select().where(Gym.name != 'Viridian').order_by(Gym.name)
+        self.db.register(Gym)
+        Gym.create(name='Pewter')
+        assert [gym.name for gym in base.get()] == ['Pewter']
+
+    def test_inverted_expression_is_a_new_expression(self):
+        expression = Trainer.age >> [17, 21]
+        inverted = ~expression
+        assert str(expression) == 'trainer.age IN (17, 21)'
+        assert str(inverted) == 'trainer.age NOT IN (17, 21)'
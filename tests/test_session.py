@@ -0,0 +1,92 @@
+from plume.plume import DeleteQuery, SelectQuery, Session, UpdateQuery
+from utils import BaseTestCase, Pokemon, Trainer
+
+import pytest
+
+
+class TestSessionAPI(BaseTestCase):
+
+    def test_is_slotted(self):
+        with pytest.raises(AttributeError):
+            Session(self.db).__dict__
+
+    def test_session_returns_a_Session(self):
+        assert isinstance(self.db.session(), Session) is True
+
+    def test_session_is_only_active_inside_context(self):
+        with self.db.session() as session:
+            assert self.db._session is session
+        assert self.db._session is None
+
+
+class TestSessionIdentityMap(BaseTestCase):
+
+    def setup_method(self):
+        super().setup_method()
+        self.statements = []
+        self.db._connection.set_trace_callback(self.statements.append)
+
+    def test_same_row_is_loaded_as_the_same_instance(self):
+        self.add_trainer(['Giovanni', 'James'])
+        with self.db.session():
+            first = SelectQuery(self.db).tables(Trainer).get()
+            second = SelectQuery(self.db).tables(Trainer).where(Trainer.name == 'James').get()
+        assert second[0] is first[1]
+
+    def test_rows_are_loaded_as_new_instances_without_session(self):
+        self.add_trainer('Giovanni')
+        first = SelectQuery(self.db).tables(Trainer)[0]
+        second = SelectQuery(self.db).tables(Trainer)[0]
+        assert first is not second
+
+    def test_lookup_by_primary_key_does_not_query_the_database(self):
+        self.add_trainer('Giovanni')
+        with self.db.session():
+            giovanni = Trainer.where(Trainer.pk == 1)[0]
+            del self.statements[:]
+            assert Trainer.where(Trainer.pk == 1)[0] is giovanni
+        assert self.statements == []
+
+    def test_foreign_key_lookup_does_not_query_the_database(self):
+        self.add_trainer('Giovanni')
+        self.add_pokemon(['Kangaskhan', 'Kangaskhan'])
+        with self.db.session():
+            giovanni = Trainer.where(Trainer.pk == 1)[0]
+            first, second = SelectQuery(self.db).tables(Pokemon).get()
+            del self.statements[:]
+            assert first.trainer is giovanni
+            assert second.trainer is giovanni
+        assert self.statements == []
+
+    def test_created_instance_is_stored_in_session(self):
+        with self.db.session():
+            giovanni = Trainer.create(name='Giovanni', age=42)
+            assert Trainer.where(Trainer.pk == giovanni.pk)[0] is giovanni
+
+    def test_writes_evict_instances_of_the_table(self):
+        self.add_trainer('Giovanni')
+        with self.db.session() as session:
+            giovanni = Trainer.where(Trainer.pk == 1)[0]
+            UpdateQuery(self.db).table(Trainer).fields(Trainer.age == 43).execute()
+            assert len(session) == 0
+            reloaded = Trainer.where(Trainer.pk == 1)[0]
+        assert reloaded is not giovanni
+        assert reloaded.age == 43
+
+    def test_inserts_keep_instances_of_the_table(self):
+        self.add_trainer('Giovanni')
+        with self.db.session():
+            giovanni = Trainer.where(Trainer.pk == 1)[0]
+            Trainer.create(name='James', age=21)
+            assert Trainer.where(Trainer.pk == 1)[0] is giovanni
+
+    def test_write_by_primary_key_only_evicts_its_instance(self):
+        self.add_trainer(['Giovanni', 'James'])
+        with self.db.session():
+            giovanni = Trainer.where(Trainer.pk == 1)[0]
+            james = Trainer.where(Trainer.pk == 2)[0]
+            UpdateQuery(self.db).table(Trainer).fields(Trainer.age == 22).where(Trainer.pk == 2).execute()
+            assert Trainer.where(Trainer.pk == 1)[0] is giovanni
+            reloaded = Trainer.where(Trainer.pk == 2)[0]
+        assert reloaded is not james
+        assert reloaded.age == 22
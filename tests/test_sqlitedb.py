@@ -1,12 +1,15 @@
 from plume.plume import (
-    CreateQuery, DeleteQuery, DropQuery, InsertQuery, Model,
-    SelectQuery, SQLiteDB, UpdateQuery
+    CreateQuery, DeleteQuery, DropQuery, InsertQuery, Maintenance, Model,
+    NPlusOneError, SelectQuery, SQLiteDB, UpdateQuery, fingerprint, fn,
 )
-from utils import DB_NAME, Pokemon, Trainer
+from utils import BaseTestCase, DB_NAME, Pokemon, Trainer
 
 from contextlib import closing
+import json
 import os
 import pytest
+import sqlite3
+import threading
 
 
 class TestSQLiteDBAPI:
@@ -177,6 +180,11 @@ class TestSQLiteDBSelectQueryBuilder:
         expected = 'SELECT * FROM trainer LIMIT 10 OFFSET 42'
         assert self.db.build_select(query) == expected
 
+    def test_select_from_one_table_with_order_by_and_limit(self):
+        query = self.db.select().tables(Trainer).order_by(Trainer.name).limit(10)
+        expected = 'SELECT * FROM trainer ORDER BY trainer.name LIMIT 10'
+        assert self.db.build_select(query) == expected
+
 
 class TestSQLiteDBUpdateQueryBuilder:
     db = SQLiteDB(':memory:')
@@ -200,5 +208,218 @@ class TestSQLiteDBUpdateQueryBuilder:
         assert self.db.build_update(query) == expected
 
 
+class TestSQLiteDBFunctions(BaseTestCase):
+
+    def setup_method(self):
+        super().setup_method()
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+
+        @self.db.function()
+        def initial(name):
+            return name[0]
+
+        @self.db.aggregate('longest')
+        class Longest:
+            def __init__(self):
+                self.value = ''
+
+            def step(self, value):
+                self.value = max(self.value, value, key=len)
+
+            def finalize(self):
+                return self.value
+
+    def test_fn_outputs_a_function_call(self):
+        assert str(fn.initial(Trainer.name, 'x', 1)) == "initial(trainer.name, 'x', 1)"
+
+    def test_function_in_where_clause(self):
+        result = Trainer.select(Trainer.name).where(fn.initial(Trainer.name) == 'J').execute()
+        assert result == [('James',), ('Jessie',)]
+
+    def test_function_in_select_and_order_by_clauses(self):
+        result = Trainer.select(fn.initial(Trainer.name)).order_by(fn.initial(Trainer.name)).execute()
+        assert result == [('G',), ('J',), ('J',)]
+
+    def test_aggregate(self):
+        assert Trainer.select(fn.longest(Trainer.name)).execute() == [('Giovanni',)]
 
+    def test_deterministic_function_can_be_indexed(self):
+        self.db._connection.execute('CREATE INDEX trainer_initial ON trainer(initial(name))')
 
+    def test_non_deterministic_function_can_not_be_indexed(self):
+        self.db.function('volatile', deterministic=False)(lambda value: value)
+        with pytest.raises(sqlite3.OperationalError):
+            self.db._connection.execute('CREATE INDEX trainer_volatile ON trainer(volatile(name))')
+
+    def test_functions_are_registered_on_new_connections(self):
+        connection = self.db._connect()
+        assert connection.execute("SELECT initial('Plume')").fetchone() == ('P',)
+
+
+class TestSQLiteDBMaintenance:
+
+    @pytest.fixture(autouse=True)
+    def database(self, tmp_path):
+        path = str(tmp_path / 'plume.db')
+        connection = sqlite3.connect(path)
+        connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.close()
+        self.db = SQLiteDB(path)
+        self.db.register(Trainer)
+        yield
+        self.db.stop_maintenance()
+
+    def add_trainers(self, count):
+        Trainer.create_many([{'name': 'Trainer' * 100, 'age': age} for age in range(count)])
+
+    def test_run_once_checkpoints_the_wal(self):
+        self.add_trainers(10)
+        report = Maintenance(self.db).run_once()
+        assert report.skipped is False
+        assert report.checkpoint == 'PASSIVE'
+        assert report.wal_frames > 0
+
+    def test_run_once_refreshes_the_query_planner_statistics(self):
+        self.add_trainers(10)
+        Maintenance(self.db).run_once()
+        stats = self.db._connection.execute('SELECT tbl, stat FROM sqlite_stat1').fetchall()
+        assert ('trainer', '10') in stats
+
+    def test_in_memory_database_can_not_be_maintained(self):
+        with pytest.raises(ValueError):
+            SQLiteDB(':memory:').start_maintenance()
+
+    def test_run_once_truncates_a_large_wal(self):
+        self.add_trainers(10)
+        report = Maintenance(self.db, truncate_frames=1).run_once()
+        assert report.checkpoint == 'TRUNCATE'
+
+    def test_run_once_reclaims_free_pages(self):
+        self.add_trainers(500)
+        DeleteQuery(self.db).table(Trainer).execute()
+        report = Maintenance(self.db, vacuum_pages=1).run_once()
+        assert report.freed_pages > 0
+
+    def test_run_once_is_skipped_under_write_load(self):
+        maintenance = Maintenance(self.db, max_writes=1)
+        self.add_trainers(1)
+        self.add_trainers(1)
+        report = maintenance.run_once()
+        assert report.skipped is True
+        assert report.writes == 2
+        assert maintenance.run_once().skipped is False
+
+    def test_start_maintenance_runs_cycles_in_background(self):
+        reports = []
+        ran = threading.Event()
+        self.db.start_maintenance(interval=0.01, on_run=lambda report: (reports.append(report), ran.set()))
+        assert ran.wait(5) is True
+        self.db.stop_maintenance()
+        assert self.db._maintenance is None
+        assert reports[0].skipped is False
+
+
+class TestSQLiteDBQueryStats(BaseTestCase):
+
+    def test_fingerprint_strips_literals(self):
+        raw_query = "SELECT * FROM trainer WHERE trainer.name = 'Farfetch''d' AND trainer.age > 18 LIMIT 1"
+        expected = 'SELECT * FROM trainer WHERE trainer.name = ? AND trainer.age > ? LIMIT ?'
+        assert fingerprint(raw_query) == expected
+
+    def test_fingerprint_collapses_lists_of_values(self):
+        assert fingerprint('SELECT * FROM trainer WHERE trainer.pk IN (1, 2, 3)') == (
+            'SELECT * FROM trainer WHERE trainer.pk IN (...)'
+        )
+        assert fingerprint('INSERT INTO trainer (age, name) VALUES (?, ?)') == (
+            'INSERT INTO trainer (age, name) VALUES (...)'
+        )
+
+    def test_queries_of_the_same_shape_are_aggregated(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        self.db.stats.reset()
+        for age in (17, 21, 42):
+            Trainer.where(Trainer.age == age).get()
+
+        top = self.db.stats.top(1)
+        assert len(top) == 1
+        assert top[0].fingerprint == 'SELECT * FROM trainer WHERE trainer.age = ?'
+        assert top[0].count == 3
+        assert top[0].rows == 3
+        assert top[0].p50 <= top[0].p99 <= top[0].total_time
+
+    def test_top_sorts_fingerprints(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        Trainer.where(Trainer.age > 0).get()
+        Trainer.where(Trainer.age > 0).get()
+        top = self.db.stats.top(2, by='count')
+        assert top[0].fingerprint.startswith('INSERT INTO trainer')
+        assert top[0].count == 3
+        assert top[1].count == 2
+        assert self.db.stats.top(1, by='rows')[0].fingerprint == 'SELECT * FROM trainer WHERE trainer.age > ?'
+
+    def test_top_with_unknown_statistic(self):
+        with pytest.raises(ValueError):
+            self.db.stats.top(by='fingerprint')
+
+    def test_dump_as_text_and_json(self):
+        self.add_trainer('Giovanni')
+        text = self.db.stats.dump()
+        assert 'INSERT INTO trainer (age, name) VALUES (...)' in text
+        result = json.loads(self.db.stats.dump(format='json'))
+        assert {stats['fingerprint'] for stats in result} >= {'INSERT INTO trainer (age, name) VALUES (...)'}
+
+    def test_stats_can_be_disabled(self):
+        self.db.stats.reset()
+        self.db.stats.enabled = False
+        self.add_trainer('Giovanni')
+        assert len(self.db.stats) == 0
+
+
+class TestNPlusOneDetector(BaseTestCase):
+
+    def setup_method(self):
+        super().setup_method()
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        self.add_pokemon(['Kangaskhan', 'Koffing', 'Wobbuffet'])
+
+    def test_lazy_foreign_key_lookups_in_a_loop_are_detected(self):
+        with pytest.raises(NPlusOneError) as error:
+            with self.db.detect_n_plus_one(threshold=2):
+                for pokemon in Pokemon.select().get():
+                    pokemon.trainer
+
+        assert 'SELECT * FROM trainer WHERE trainer.pk = ?' in str(error.value)
+        assert __file__ in str(error.value)
+
+    def test_violations_report_counts_and_call_sites(self):
+        with self.db.detect_n_plus_one(threshold=2, raise_on_exit=False) as detector:
+            for pokemon in Pokemon.select().get():
+                pokemon.trainer
+
+        violation, = detector.violations()
+        assert violation.count == 3
+        (call_site, count), = violation.call_sites
+        assert call_site.startswith(__file__)
+        assert count == 3
+
+    def test_queries_under_the_threshold_are_not_reported(self):
+        with self.db.detect_n_plus_one(threshold=3) as detector:
+            for pokemon in Pokemon.select().get():
+                pokemon.trainer
+        assert detector.violations() == []
+
+    def test_repeated_identical_queries_are_not_reported(self):
+        with self.db.detect_n_plus_one(threshold=2) as detector:
+            for _ in range(5):
+                Trainer.where(Trainer.pk == 1).get()
+        assert detector.violations() == []
+
+    def test_writes_are_not_watched(self):
+        with self.db.detect_n_plus_one(threshold=2):
+            self.add_trainer(['Giovanni', 'James', 'Jessie'])
+
+    def test_detector_stops_watching_on_exit(self):
+        with self.db.detect_n_plus_one():
+            pass
+        assert self.db._listeners == []
@@ -33,6 +33,11 @@ class TestUpdateQueryAPI:
         expected = "UPDATE trainer SET name = 'Giovanni', age = 18"
         assert query.build() == expected
         
+    def test_updates_rules_are_not_altered(self):
+        rule = Trainer.age == 18
+        UpdateQuery(db=self.db).table(Trainer).fields(rule)
+        assert str(rule) == 'trainer.age = 18'
+
     def test_can_output_selectquery_as_string(self):
         query = UpdateQuery(db=self.db).table(Trainer).fields(Trainer.name == 'Jessie').where(Trainer.age < 18)
         expected = "(UPDATE trainer SET name = 'Jessie' WHERE trainer.age < 18)"
@@ -90,3 +95,35 @@ class TestUpdateQueryResult(BaseTestCase):
         assert jessie[0] == 42
         assert james[0] == 21
 
+    def test_update_with_column_arithmetic(self):
+        self.add_trainer(['James', 'Jessie'])
+        Trainer.update(Trainer.age == Trainer.age + 1).where(Trainer.name == 'Jessie').execute()
+        ages = Trainer._db._connection.execute('SELECT age FROM trainer').fetchall()
+        assert ages == [(21,), (18,)]
+
+    def test_update_with_string_concatenation(self):
+        self.add_trainer(['James'])
+        Trainer.update(Trainer.name == Trainer.name.concat(' & Jessie')).execute()
+        name = Trainer._db._connection.execute('SELECT name FROM trainer').fetchone()[0]
+        assert name == 'James & Jessie'
+
+
+class TestUpdateQueryBatches(BaseTestCase):
+
+    def test_update_filtered_rows_by_batches(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie', 'James'])
+        updated = (
+            UpdateQuery(db=self.db).table(Trainer).fields(Trainer.age == 30)
+            .where(Trainer.age < 30).execute(batch_size=2)
+        )
+        assert updated == 3
+        ages = Trainer._db._connection.execute('SELECT age FROM trainer').fetchall()
+        assert ages == [(42,), (30,), (30,), (30,)]
+
+    def test_update_by_batches_reports_progress(self):
+        self.add_trainer(['Giovanni', 'James', 'Jessie'])
+        progress = []
+        UpdateQuery(db=self.db).table(Trainer).fields(Trainer.age == 30).execute(
+            batch_size=2, progress=progress.append
+        )
+        assert progress == [2, 3]